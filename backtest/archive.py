@@ -0,0 +1,72 @@
+import bisect
+import json
+import logging
+
+from eth_abi import encode
+
+from blockchain.ltv import USER_STATE_OUTPUT_TYPES, decode_user_state_ltv
+
+logger = logging.getLogger("backtest_archive")
+
+class CannedArchive:
+    """
+    離線的 archive node 替身，讀取預先錄好的鏈上狀態 (JSON)。
+
+    格式：
+    {
+        "states": {
+            "<safe>": [[block, total_collateral_usd, total_debt_usd], ...]
+        },
+        "liquidations": [{"safe": "<safe>", "block": 123}]
+    }
+
+    某個 Safe 在 block N 的狀態 = 不晚於 N 的最後一筆紀錄 (與真實鏈上狀態一樣延續到下次變動)。
+    get_ltv_batch 的介面與 DataFetcher 相同，回傳值也走同一套 ABI 解碼，
+    回測引擎不需要知道背後是真的節點還是罐頭資料。
+    """
+
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        self._blocks = {}
+        self._states = {}
+        for safe, entries in data.get("states", {}).items():
+            entries = sorted(entries)
+            self._blocks[safe.lower()] = [e[0] for e in entries]
+            self._states[safe.lower()] = [(e[1], e[2]) for e in entries]
+
+        self.liquidations = [
+            {"safe": liq["safe"].lower(), "block": int(liq["block"])}
+            for liq in data.get("liquidations", [])
+        ]
+
+    @property
+    def safes(self) -> list[str]:
+        return list(self._blocks)
+
+    def _state_at(self, safe: str, block: int):
+        blocks = self._blocks.get(safe.lower())
+        if not blocks:
+            return None
+        i = bisect.bisect_right(blocks, block) - 1
+        if i < 0:
+            return None # 該區塊時 Safe 還不存在
+        return self._states[safe.lower()][i]
+
+    def get_ltv_batch(self, addresses: list[str], block_identifier="latest") -> dict[str, float]:
+        if block_identifier == "latest":
+            block_identifier = max((b[-1] for b in self._blocks.values()), default=0)
+
+        ltv_map = {}
+        for addr in addresses:
+            state = self._state_at(addr, int(block_identifier))
+            if state is None:
+                # 與 Multicall 中 allowFailure 的呼叫失敗相同
+                ltv_map[addr] = -1.0
+                continue
+
+            total_collateral, total_debt = state
+            return_data = encode(USER_STATE_OUTPUT_TYPES, [[], total_collateral, [], total_debt])
+            ltv_map[addr] = decode_user_state_ltv(return_data)
+        return ltv_map
@@ -0,0 +1,290 @@
+"""
+歷史重播 / 回測：用過去區塊的鏈上狀態重跑 get_ltv_batch，
+檢查各個警報閾值會在何時觸發、觸發幾次，以及比清算提早了多少區塊。
+
+用法：
+    # 離線：使用錄好的罐頭狀態
+    python -m backtest.replay --archive canned.json --from 100 --to 2000 --step 10 --thresholds 70,80,90
+
+    # 連 archive node (SCROLL_RPC_URL)
+    python -m backtest.replay --rpc --safes 0xabc...,0xdef... --liquidations liq.json --from ... --to ...
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from backtest.archive import CannedArchive
+
+logger = logging.getLogger("backtest_replay")
+
+DEFAULT_CACHE_DIR = "./.backtest_cache"
+
+# --- 資料來源 ---
+
+def open_source(spec: dict):
+    """
+    依 spec 建立資料來源。spec 是純 dict，才能交給子行程自己建立連線：
+    - {"kind": "archive", "path": "..."}: CannedArchive
+    - {"kind": "rpc"}: DataFetcher (需要 archive node)
+    """
+    if spec["kind"] == "archive":
+        return CannedArchive(spec["path"])
+    if spec["kind"] == "rpc":
+        # 延遲 import：blockchain.client 在 import 時就會連線 RPC
+        from blockchain.fetcher import DataFetcher
+        return DataFetcher()
+    raise ValueError(f"Unknown source kind: {spec['kind']}")
+
+def _source_tag(spec: dict) -> str:
+    """
+    快取目錄名稱；罐頭檔案內容改變 (mtime) 時快取自動失效。
+    RPC 來源以節點 URL 與 DebtManager 地址區分，換鏈或換合約不會誤用舊快取。
+    """
+    payload = dict(spec)
+    if spec["kind"] == "archive":
+        payload["mtime"] = os.path.getmtime(spec["path"])
+    elif spec["kind"] == "rpc":
+        import config
+        payload["rpc_url"] = config.SCROLL_RPC_URL
+        payload["debt_manager"] = (config.DEBT_MANAGER_ADDR or "").lower()
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+# --- Worker ---
+
+def _replay_range(spec: dict, addresses: list[str], blocks: list[int], cache_dir: str) -> dict[int, list[float]]:
+    """
+    在子行程中重播一段區塊，回傳 {block: [ltv, ...]} (順序與 addresses 相同，查詢失敗為 NaN)。
+
+    每個區塊的結果以 JSON 快取在 cache_dir/<source_tag>/<block>.json，
+    重跑或擴大 Safe 清單時只會補查缺少的地址。
+    """
+    tag_dir = os.path.join(cache_dir, _source_tag(spec))
+    os.makedirs(tag_dir, exist_ok=True)
+
+    source = None
+    out = {}
+    for block in blocks:
+        path = os.path.join(tag_dir, f"{block}.json")
+        cached = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+
+        missing = [a for a in addresses if a not in cached]
+        if missing:
+            if source is None:
+                source = open_source(spec)
+            fetched = {k.lower(): v for k, v in source.get_ltv_batch(missing, block_identifier=block).items()}
+
+            # RPC 失敗的地址不會出現在 fetched 中：不寫入快取，下次重跑會再查
+            failed = [a for a in missing if a not in fetched]
+            if failed:
+                logger.warning(f"Block {block}: {len(failed)} addresses failed to fetch, treating as missing data")
+
+            if len(failed) < len(missing):
+                cached.update({a: fetched[a] for a in missing if a in fetched})
+                # 先寫暫存檔再換名，避免中斷時留下半個 JSON
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(cached, f)
+                os.replace(tmp_path, path)
+
+        out[block] = [cached.get(a, np.nan) for a in addresses]
+    return out
+
+# --- 分析 ---
+
+def analyze(addresses: list[str], blocks: np.ndarray, ltv: np.ndarray, thresholds, liquidations) -> dict:
+    """
+    ltv: shape (len(addresses), len(blocks))，查詢失敗為 NaN (-1.0 則是沒有部位)。
+
+    觸發 (fire) 定義為 LTV 由 <= 閾值變成 > 閾值的那個取樣區塊 (與 monitor loop 相同的比較)。
+    查詢失敗的取樣沿用前一個取樣值，缺資料不會切斷持續超標的區間而重複觸發。
+    每筆清算的 lead time = 清算區塊 - 該 Safe 在清算前最後一次觸發的區塊；
+    沒有在清算前觸發則記為 missed。沒有對應到任何清算的觸發計為 false alarm。
+    """
+    index = {addr: i for i, addr in enumerate(addresses)}
+    liqs_by_safe = {}
+    for liq in liquidations:
+        if liq["safe"] in index:
+            liqs_by_safe.setdefault(liq["safe"], []).append(liq["block"])
+
+    ltv = _forward_fill(ltv)
+
+    report = {}
+    for threshold in thresholds:
+        above = ltv > threshold
+        prev = np.zeros_like(above)
+        prev[:, 1:] = above[:, :-1]
+        fires = above & ~prev
+
+        safes = {}
+        leads = []
+        total_fires = 0
+        useful_fires = 0
+        missed = 0
+
+        for addr, i in index.items():
+            fire_idx = np.flatnonzero(fires[i])
+            total_fires += len(fire_idx)
+            used = set()
+            liq_report = []
+
+            for liq_block in sorted(liqs_by_safe.get(addr, [])):
+                # 清算前 (含) 最後一個取樣點
+                last = np.searchsorted(blocks, liq_block, side="right") - 1
+                prior = fire_idx[fire_idx <= last]
+                if len(prior) == 0:
+                    missed += 1
+                    liq_report.append({"block": liq_block, "lead_blocks": None})
+                    continue
+
+                fire = int(prior[-1])
+                lead = int(liq_block - blocks[fire])
+                used.add(fire)
+                leads.append(lead)
+                liq_report.append({"block": liq_block, "lead_blocks": lead})
+
+            useful_fires += len(used)
+            safes[addr] = {
+                "fires": [int(b) for b in blocks[fire_idx]],
+                "liquidations": liq_report,
+            }
+
+        report[threshold] = {
+            "summary": {
+                "fires": total_fires,
+                "liquidations": len(leads) + missed,
+                "caught": len(leads),
+                "missed": missed,
+                "false_alarms": total_fires - useful_fires,
+                "median_lead_blocks": float(np.median(leads)) if leads else None,
+                "min_lead_blocks": int(min(leads)) if leads else None,
+            },
+            "safes": safes,
+        }
+    return report
+
+def _forward_fill(ltv: np.ndarray) -> np.ndarray:
+    """每列的 NaN 以左邊最近的有效值填補 (開頭的 NaN 保持 NaN，比較時視為未超標)"""
+    valid = ~np.isnan(ltv)
+    idx = np.where(valid, np.arange(ltv.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    return ltv[np.arange(ltv.shape[0])[:, None], idx]
+
+# --- 進入點 ---
+
+def replay(
+    spec: dict,
+    addresses: list[str],
+    start_block: int,
+    end_block: int,
+    step: int = 1,
+    thresholds=(80.0,),
+    liquidations=None,
+    workers: int = None,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+) -> dict:
+    """
+    重播 [start_block, end_block] (每 step 個區塊取樣一次) 並產生回測報告。
+
+    區塊範圍會切成多段交給 process pool 平行處理；workers=1 時在本行程內執行。
+    """
+    addresses = [a.lower() for a in addresses]
+    blocks = np.arange(start_block, end_block + 1, step, dtype=np.int64)
+    if not len(blocks) or not addresses:
+        return {}
+
+    workers = workers or os.cpu_count() or 1
+    # 切得比 worker 數多一些，讓快的 worker 可以多拿幾段
+    chunks = [c.tolist() for c in np.array_split(blocks, min(len(blocks), workers * 4))]
+
+    results = {}
+    if workers == 1:
+        for chunk in chunks:
+            results.update(_replay_range(spec, addresses, chunk, cache_dir))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_replay_range, spec, addresses, chunk, cache_dir) for chunk in chunks]
+            for future in futures:
+                results.update(future.result())
+
+    ltv = np.array([results[int(b)] for b in blocks], dtype=np.float32).T
+
+    if liquidations is None:
+        liquidations = open_source(spec).liquidations if spec["kind"] == "archive" else []
+    liquidations = [{"safe": liq["safe"].lower(), "block": int(liq["block"])} for liq in liquidations]
+
+    return analyze(addresses, blocks, ltv, thresholds, liquidations)
+
+def format_report(report: dict, block_time: float = None) -> str:
+    lines = []
+    for threshold, result in report.items():
+        s = result["summary"]
+        lead = s["median_lead_blocks"]
+        lead_str = "n/a" if lead is None else f"{lead:.0f} blocks"
+        if lead is not None and block_time:
+            lead_str += f" (~{lead * block_time / 60:.1f} min)"
+
+        lines.append(
+            f"Threshold {threshold:g}%: fires={s['fires']} caught={s['caught']}/{s['liquidations']} "
+            f"missed={s['missed']} false_alarms={s['false_alarms']} median_lead={lead_str}"
+        )
+        for addr, safe in result["safes"].items():
+            for liq in safe["liquidations"]:
+                status = "MISSED" if liq["lead_blocks"] is None else f"lead {liq['lead_blocks']} blocks"
+                lines.append(f"    {addr[:6]}...{addr[-4:]} liquidated @ {liq['block']}: {status}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay historical blocks to backtest LTV alert thresholds.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--archive", help="Canned archive JSON (offline)")
+    source.add_argument("--rpc", action="store_true", help="Use SCROLL_RPC_URL (must be an archive node)")
+    parser.add_argument("--safes", help="Comma-separated safe addresses (default: all safes in the archive)")
+    parser.add_argument("--liquidations", help="JSON list of {safe, block} (default: from the archive)")
+    parser.add_argument("--from", dest="start_block", type=int, required=True)
+    parser.add_argument("--to", dest="end_block", type=int, required=True)
+    parser.add_argument("--step", type=int, default=1)
+    parser.add_argument("--thresholds", default="80", help="Comma-separated LTV thresholds (%%)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--block-time", type=float, default=None, help="Average block time (s) for lead time in minutes")
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    spec = {"kind": "archive", "path": args.archive} if args.archive else {"kind": "rpc"}
+
+    if args.safes:
+        addresses = [a.strip() for a in args.safes.split(",") if a.strip()]
+    elif args.archive:
+        addresses = CannedArchive(args.archive).safes
+    else:
+        parser.error("--safes is required with --rpc")
+
+    liquidations = None
+    if args.liquidations:
+        with open(args.liquidations, "r", encoding="utf-8") as f:
+            liquidations = json.load(f)
+
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    report = replay(
+        spec, addresses, args.start_block, args.end_block, args.step,
+        thresholds=thresholds, liquidations=liquidations,
+        workers=args.workers, cache_dir=args.cache_dir,
+    )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report, args.block_time))
+
+if __name__ == "__main__":
+    main()
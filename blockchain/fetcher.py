@@ -1,102 +1,279 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from web3 import Web3
-from eth_abi import decode
+from web3.exceptions import ContractLogicError
 from blockchain.client import w3
+from blockchain.ltv import compute_ltv, decode_user_state_ltv, BatchResult, STATUS_OK, STATUS_RETRIED, STATUS_STALE, STATUS_FAILED, STATUS_REVERTED
+from blockchain.lens import LENS_SATURATED, LensUnsupported, call_lens, decode_lens_result
+from blockchain.resilience import CircuitBreaker, RetryPolicy, RPCError, call_with_retry
 from blockchain.abis import DEBT_MANAGER_ABI, ETHERFI_DATA_PROVIDER_ABI, MULTICALL3_ABI
 import config 
 
 # 使用標準 Logger
 logger = logging.getLogger("blockchain_fetcher")
 
+# _fetch_chunk 的 values 中代表「這個地址本輪 RPC 失敗」(與 None = revert 區分)
+FAILED = object()
+
 class DataFetcher:
     def __init__(self):
         self.debt_manager = w3.eth.contract(address=config.DEBT_MANAGER_ADDR, abi=DEBT_MANAGER_ABI)
         self.data_provider = w3.eth.contract(address=config.ETHERFI_DATA_PROVIDER_ADDR , abi=ETHERFI_DATA_PROVIDER_ABI)
         self.multicall = w3.eth.contract(address=config.MULTICALL3_ADDR, abi=MULTICALL3_ABI)
 
+        # RPC 韌性：重試策略與 circuit breaker (節點不健康時暫停呼叫，等 half-open 再試探，不再加重負擔)
+        self.retry_policy = RetryPolicy(config.RPC_RETRY_ATTEMPTS, config.RPC_RETRY_BASE_DELAY, config.RPC_RETRY_MAX_DELAY)
+        self.breaker = CircuitBreaker(config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_SECONDS)
+        # addr -> (ltv, 取得時間)，RPC 失敗時作為 stale 值
+        self._last_good = {}
+        # 節點是否支援 lens 所需的 state override (None = 尚未試探)
+        self._lens_supported = None
+
+    def _call(self, fn, deadline: float = None, fatal: tuple = ()):
+        """套用重試與 circuit breaker 的單次 RPC 呼叫"""
+        result, _ = call_with_retry(fn, self.retry_policy, self.breaker, deadline, fatal)
+        return result
+
     def is_safe(self, address: str) -> bool:
-        """Check if an address is a valid Ether.fi Safe."""
+        """
+        Check if an address is a valid Ether.fi Safe.
+
+        Raises RPCError when the node could not be reached, so callers can tell
+        "invalid address" apart from "try again later".
+        """
         if not w3.is_address(address):
             return False
        
         checksum_addr = w3.to_checksum_address(address)
         try:
-            return self.data_provider.functions.isEtherFiSafe(checksum_addr).call()
-        except Exception as e:
-            logger.error(f"Error checking safe status for {address}: {e}")
+            return self._call(self.data_provider.functions.isEtherFiSafe(checksum_addr).call, fatal=(ContractLogicError,))
+        except ContractLogicError:
             return False
+        except RPCError as e:
+            logger.error(f"Error checking safe status for {address}: {e}")
+            raise
 
     def get_ltv(self, address: str) -> float:
-        """Fetch the Loan-to-Value (LTV) ratio for a given address."""
+        """
+        Fetch the Loan-to-Value (LTV) ratio for a given address.
+
+        回傳 -1.0 代表呼叫 revert (通常是無效的 Safe)；RPC 失敗時拋出 RPCError。
+        """
         checksum_addr = w3.to_checksum_address(address)
         try:
             # 呼叫 getUserCurrentState (回傳 4 個值)
-            data = self.debt_manager.functions.getUserCurrentState(checksum_addr).call()
+            data = self._call(self.debt_manager.functions.getUserCurrentState(checksum_addr).call, fatal=(ContractLogicError,))
+        except ContractLogicError as e:
+            logger.error(f"LTV Check reverted for {address}: {e}")
+            return -1.0
+        except RPCError as e:
+            logger.error(f"LTV Check Error: {e}")
+            raise
 
-            # Index 1 是總資產 (USD), Index 3 是總負債 (USD)
-            total_collateral = data[1]
-            total_debt = data[3]
+        # Index 1 是總資產 (USD), Index 3 是總負債 (USD)
+        return compute_ltv(data[1], data[3])
 
-            if total_collateral == 0:
-                return 0.0 # 分母為 0，LTV 就是 0
+    def get_ltv_batch(self, addresses: list[str], block_identifier="latest") -> dict[str, float]:
+        """
+        Batch fetch LTV ratios using Multicall3 for efficiency.
 
-            # 計算公式：(負債 / 資產) * 100
-            # 因為單位都是 USD (例如 1e6 或 1e18)，直接除就可以，單位會消掉
-            ltv = (total_debt / total_collateral) * 100
+        block_identifier 可指定歷史區塊 (需要 archive node)，供回測重播使用。
+        查詢 revert 的地址為 -1.0；RPC 失敗的地址不會出現在回傳的 dict 中，
+        需要逐一狀態時請用 fetch_ltv_batch。
+        """
+        return self.fetch_ltv_batch(addresses, block_identifier).as_ltv_map()
 
-            return round(ltv, 2)
-        except Exception as e:
-            logger.error(f"LTV Check Error: {e}")
-            return 0.0
+    def fetch_ltv_batch(self, addresses: list[str], block_identifier="latest", deadline: float = None) -> BatchResult:
+        """
+        Batch fetch LTV ratios with per-address status.
 
-    def get_ltv_batch(self, addresses: list[str]) -> dict[str, float]:
-        """ Batch fetch LTV ratios using Multicall3 for efficiency."""
+        地址切成多批 Multicall 並行送出，每批獨立重試 (jittered exponential backoff)，
+        整體不超過 deadline 秒。某批最終失敗時，查詢最新區塊的情況下沿用上次成功的值 (stale)，
+        其餘批次的結果照常回傳。
+        """
+        result = BatchResult(block_identifier)
         if not addresses:
-            return {}
+            return result
 
         checksum_addrs = [w3.to_checksum_address(addr) for addr in addresses]
+        deadline_at = time.monotonic() + (deadline or config.FETCH_DEADLINE_SECONDS)
+        use_stale = block_identifier == "latest"
+
+        # 查最新狀態時先固定區塊高度，讓所有批次讀到同一個區塊，結果也能標記 block number
+        if block_identifier == "latest":
+            try:
+                block_identifier = self._call(lambda: w3.eth.block_number, deadline_at)
+            except RPCError as e:
+                logger.warning(f"Failed to resolve latest block number, using 'latest': {e}")
+        if isinstance(block_identifier, int):
+            result.block_number = block_identifier
+
+        size = config.MULTICALL_CHUNK_SIZE
+        chunks = [checksum_addrs[i:i + size] for i in range(0, len(checksum_addrs), size)]
+
+        def fetch(chunk):
+            return self._fetch_chunk(chunk, block_identifier, deadline_at)
+
+        if len(chunks) == 1:
+            outcomes = [fetch(chunks[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(config.FETCH_CONCURRENCY, len(chunks))) as pool:
+                outcomes = list(pool.map(fetch, chunks))
+
+        now = time.time()
+
+        for chunk, (values, retries, error) in zip(chunks, outcomes):
+            status = STATUS_RETRIED if retries else STATUS_OK
+            for i, addr in enumerate(chunk):
+                ltv = FAILED if error is not None else values[i]
+                if ltv is None:
+                    result.set(addr, -1.0, STATUS_REVERTED, now)
+                elif ltv is not FAILED:
+                    result.set(addr, ltv, status, now)
+                    if use_stale:
+                        self._last_good[addr] = (ltv, now)
+                else:
+                    last = self._last_good.get(addr) if use_stale else None
+                    if last and now - last[1] <= config.STALE_MAX_AGE_SECONDS:
+                        result.set(addr, last[0], STATUS_STALE, last[1])
+                    else:
+                        result.set(addr, -1.0, STATUS_FAILED, now)
+
+        counts = result.counts()
+        if counts.get(STATUS_OK, 0) + counts.get(STATUS_REVERTED, 0) != len(result.status):
+            logger.warning(f"Batch fetch finished with degraded results: {counts} (breaker: {self.breaker.state})")
+        return result
+
+    def _fetch_chunk(self, chunk: list[str], block_identifier, deadline_at: float):
+        """
+        查詢一批地址。回傳 (values, 重試次數, error)：
+        values 與 chunk 對齊，revert / 解碼失敗的位置為 None，個別地址 RPC 失敗的位置為 FAILED；
+        整批 RPC 失敗時 values 為 None。
+
+        節點支援 state override 時走 lens，否則 (或 lens 這批失敗時) 走 Multicall。
+        """
+        if self._lens_ready(chunk[0], block_identifier, deadline_at):
+            try:
+                values, retries, error = self._fetch_chunk_lens(chunk, block_identifier, deadline_at)
+            except (LensUnsupported, ValueError) as e:
+                # 節點拒絕 override 或回傳格式不符：之後都改用 Multicall
+                logger.warning(f"LTV lens rejected by node, falling back to Multicall: {e}")
+                self._lens_supported = False
+            except ContractLogicError as e:
+                logger.warning(f"LTV lens reverted for {len(chunk)} addresses, retrying chunk via Multicall: {e}")
+            else:
+                if error is None:
+                    return self._requery_flagged(chunk, values, retries, block_identifier, deadline_at)
+                # 例如整批超過節點的 gas 上限：這批改走 Multicall
+                logger.warning(f"LTV lens failed for {len(chunk)} addresses, retrying chunk via Multicall: {error}")
+
+        return self._fetch_chunk_multicall(chunk, block_identifier, deadline_at)
+
+    def _lens_ready(self, probe_addr: str, block_identifier, deadline_at: float) -> bool:
+        """第一次使用前試探節點是否支援 state override，且 lens 的結果與 Multicall 一致"""
+        if not config.LTV_LENS_ENABLED or self._lens_supported is False:
+            return False
+        if self._lens_supported is None:
+            # None = 這次無法判斷，先走 Multicall，下一批再試探
+            self._lens_supported = self._probe_lens(probe_addr, block_identifier, deadline_at)
+        return bool(self._lens_supported)
+
+    def _probe_lens(self, probe_addr: str, block_identifier, deadline_at: float):
+        """回傳 True (啟用) / False (停用) / None (無法判斷)"""
+        try:
+            lens_ltv, lens_ok = decode_lens_result(
+                call_lens(w3, config.DEBT_MANAGER_ADDR, [probe_addr], block_identifier), 1
+            )
+        except (LensUnsupported, ValueError, ContractLogicError) as e:
+            # ValueError：忽略 override 的節點會對空地址回傳空 bytes
+            logger.warning(f"Node does not support state override, LTV lens disabled: {e}")
+            return False
+        except Exception as e:
+            # 連線、限流等暫時性錯誤無法判斷是否支援
+            logger.warning(f"LTV lens probe failed, using Multicall for now: {e}")
+            return None
+
+        values, _, error = self._fetch_chunk_multicall([probe_addr], block_identifier, deadline_at)
+        if error is not None or (values[0] is None and not lens_ok[0]):
+            # RPC 失敗或試探地址兩邊都 revert：沒有可比對的值
+            return None
+
+        expected = values[0]
+        got = round(float(lens_ltv[0]), 2) if lens_ok[0] else None
+        saturated = got is not None and got >= LENS_SATURATED / 100
+        if expected is None or got is None or not (abs(got - expected) <= 0.01 + 1e-6 or (saturated and expected >= got)):
+            logger.error(f"LTV lens disagrees with Multicall for {probe_addr} (lens {got}, multicall {expected}), lens disabled")
+            return False
+
+        logger.info("LTV lens enabled (verified against Multicall)")
+        return True
+
+    def _fetch_chunk_lens(self, chunk: list[str], block_identifier, deadline_at: float):
+        """以 lens 查詢一批地址，回傳格式同 _fetch_chunk (失敗旗標的位置為 None，由 _requery_flagged 處理)"""
+        try:
+            raw, retries = call_with_retry(
+                lambda: call_lens(w3, config.DEBT_MANAGER_ADDR, chunk, block_identifier),
+                self.retry_policy, self.breaker, deadline_at, fatal=(LensUnsupported, ContractLogicError),
+            )
+        except RPCError as e:
+            logger.error(f"LTV lens failed for {len(chunk)} addresses: {e}")
+            return None, 0, e
+
+        ltv, ok = decode_lens_result(raw, len(chunk))
+        # bps / 100 直接在 float64 下取兩位小數，與 compute_ltv 的格式一致
+        values = [round(v, 2) if success else None for v, success in zip(ltv.astype(float).tolist(), ok.tolist())]
+        return values, retries, None
+
+    def _requery_flagged(self, chunk: list[str], values: list, retries: int, block_identifier, deadline_at: float):
+        """
+        lens 的失敗旗標無法分辨「Safe revert」與「整個 eth_call 的 gas 用完」，
+        所以被標記的地址一律改用 Multicall 重查；重查也失敗的記為 FAILED。
+        """
+        flagged = [i for i, value in enumerate(values) if value is None]
+        if not flagged:
+            return values, retries, None
+
+        sub_values, sub_retries, error = self._fetch_chunk_multicall(
+            [chunk[i] for i in flagged], block_identifier, deadline_at
+        )
+        for j, i in enumerate(flagged):
+            values[i] = FAILED if error is not None else sub_values[j]
+        return values, max(retries, sub_retries), None
+
+    def _fetch_chunk_multicall(self, chunk: list[str], block_identifier, deadline_at: float):
+        """以 Multicall3 查詢一批地址，回傳格式同 _fetch_chunk"""
         calls = []
 
         # 1. 準備 Multicall 請求
-        for addr in checksum_addrs:
+        for addr in chunk:
             # 使用 getUserCurrentState 查詢
             # Web3.py v6+ 使用 encode_abi() 而非 encodeABI()
             call_data = self.debt_manager.functions.getUserCurrentState(addr)._encode_transaction_data()
             # 構造 Call3 結構: (target, allowFailure, callData)
             calls.append((config.DEBT_MANAGER_ADDR, True, call_data))
 
+        # 2. 發送 RPC 請求 (含重試)
         try:
-            # 2. 發送單次 RPC 請求
-            results = self.multicall.functions.aggregate3(calls).call()
-            ltv_map = {}
-            
-            # 定義解碼格式 (根據 ABI)
-            # (token_data[], totalCollateral, token_data[], totalDebt)
-            output_type_str = '((address,uint256)[],uint256,(address,uint256)[],uint256)'
-
-            # 3. 解析結果
-            for i, (success, return_data) in enumerate(results):
-                addr = checksum_addrs[i]
-                if success and len(return_data) > 0:
-                    try:
-                        decoded_data = decode([output_type_str], return_data)[0]
-                        total_collateral = decoded_data[1]
-                        total_debt = decoded_data[3]
-                        
-                        if total_collateral == 0:
-                            ltv_map[addr] = 0.0
-                        else:
-                            ltv_map[addr] = round((total_debt / total_collateral) * 100, 2)
-                    except Exception as decode_err:
-                        logger.error(f"Decode error for {addr}: {decode_err}")
-                        ltv_map[addr] = -1.0
-                else:
-                    ltv_map[addr] = -1.0
-            
-            return ltv_map
+            results, retries = call_with_retry(
+                lambda: self.multicall.functions.aggregate3(calls).call(block_identifier=block_identifier),
+                self.retry_policy, self.breaker, deadline_at,
+            )
+        except RPCError as e:
+            logger.error(f"Multicall failed for {len(chunk)} addresses: {e}")
+            return None, 0, e
 
-        except Exception as e:
-            logger.error(f"Multicall failed: {e}")
-            return {}
+        # 3. 解析結果
+        values = []
+        for addr, (success, return_data) in zip(chunk, results):
+            if success and len(return_data) > 0:
+                try:
+                    values.append(decode_user_state_ltv(return_data))
+                except Exception as decode_err:
+                    logger.error(f"Decode error for {addr}: {decode_err}")
+                    values.append(None)
+            else:
+                values.append(None)
+        return values, retries, None
         
 Fetcher = DataFetcher()
\ No newline at end of file
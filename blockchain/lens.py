@@ -0,0 +1,187 @@
+"""
+LTV lens：透過 eth_call 的 state override，把一段唯讀 helper bytecode 暫時放到一個空地址上執行。
+
+Helper 在節點端逐一呼叫 DebtManager.getUserCurrentState，只把結果算成 uint16 basis points 回傳，
+不必把每個 Safe 的兩個動態 token 陣列傳回 client，回應大小約縮小 10 倍以上，
+client 端解碼也只剩一次 numpy.frombuffer。
+
+Calldata (無 selector)：
+    [0:32]          DebtManager 地址 (左補零)
+    [32 + 32*i]     第 i 個 Safe 地址 (左補零)
+回傳：
+    N 個 big-endian uint16：LTV (basis points, 0.01%)
+    - LENS_FAILED (0xFFFF) 代表呼叫 revert 或回傳長度不足
+    - LENS_SATURATED (0xFFFE) 代表 LTV >= 655.34%
+"""
+import numpy as np
+from eth_utils import keccak, to_checksum_address
+from web3.exceptions import Web3RPCError
+
+# 任意選一個不會有程式碼的地址 ("ltv-lens")，只存在於 state override 中
+LENS_ADDRESS = to_checksum_address("0x000000000000000000000000006c74762d6c656e")
+
+LENS_FAILED = 0xFFFF
+LENS_SATURATED = 0xFFFE
+
+# JSON-RPC "invalid params"：不接受 eth_call 第三個參數的節點會回這個
+_INVALID_PARAMS = -32602
+_UNSUPPORTED_MARKERS = ("too many arguments", "state override", "stateoverride", "not supported", "unsupported")
+
+class LensUnsupported(Exception):
+    """節點明確表示不支援 eth_call 的 state override (與逾時、限流等暫時性錯誤不同)"""
+
+def is_override_unsupported(error: Exception) -> bool:
+    response = getattr(error, "rpc_response", None)
+    detail = response.get("error") if isinstance(response, dict) else None
+    if isinstance(detail, dict) and detail.get("code") == _INVALID_PARAMS:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _UNSUPPORTED_MARKERS)
+
+GET_USER_CURRENT_STATE_SELECTOR = keccak(text="getUserCurrentState(address)")[:4]
+
+_OPCODES = {
+    "STOP": 0x00, "ADD": 0x01, "MUL": 0x02, "SUB": 0x03, "DIV": 0x04,
+    "LT": 0x10, "GT": 0x11, "EQ": 0x14, "ISZERO": 0x15, "AND": 0x16, "SHL": 0x1B, "SHR": 0x1C,
+    "CALLDATALOAD": 0x35, "CALLDATASIZE": 0x36, "CODECOPY": 0x39,
+    "RETURNDATASIZE": 0x3D, "RETURNDATACOPY": 0x3E,
+    "POP": 0x50, "MLOAD": 0x51, "MSTORE": 0x52, "MSTORE8": 0x53,
+    "JUMP": 0x56, "JUMPI": 0x57, "GAS": 0x5A, "JUMPDEST": 0x5B,
+    "DUP1": 0x80, "DUP2": 0x81,
+    "RETURN": 0xF3, "STATICCALL": 0xFA, "REVERT": 0xFD,
+}
+
+def assemble(program: list) -> bytes:
+    """
+    極簡組譯器。program 內容：
+    - "OPCODE"
+    - ("PUSH", n, value)：PUSHn 常數
+    - ("PUSH_LABEL", name)：PUSH2 label 位址
+    - ("LABEL", name)：標記位置 (需自行接 JUMPDEST)
+    """
+    # 第一遍計算 label 位置，第二遍輸出
+    labels = {}
+    pc = 0
+    for item in program:
+        if isinstance(item, str):
+            pc += 1
+        elif item[0] == "LABEL":
+            labels[item[1]] = pc
+        elif item[0] == "PUSH":
+            pc += 1 + item[1]
+        elif item[0] == "PUSH_LABEL":
+            pc += 3
+
+    code = bytearray()
+    for item in program:
+        if isinstance(item, str):
+            code.append(_OPCODES[item])
+        elif item[0] == "PUSH":
+            code.append(0x5F + item[1])
+            code += int(item[2]).to_bytes(item[1], "big")
+        elif item[0] == "PUSH_LABEL":
+            code.append(0x61)
+            code += labels[item[1]].to_bytes(2, "big")
+    return bytes(code)
+
+# 記憶體配置：
+#   0x00..0x24  呼叫 DebtManager 的 calldata (selector + safe)
+#   0x40, 0x60  getUserCurrentState 回傳的 totalCollateralInUsd / totalBorrowings
+#   0x100..     輸出 (每個 Safe 2 bytes)
+_OUT = 0x100
+
+_LENS_PROGRAM = [
+    # n = (calldatasize - 32) / 32
+    ("PUSH", 1, 0x20), "CALLDATASIZE", "SUB", ("PUSH", 1, 5), "SHR",
+    # mstore(0, selector << 224)
+    ("PUSH", 4, int.from_bytes(GET_USER_CURRENT_STATE_SELECTOR, "big")), ("PUSH", 1, 0xE0), "SHL",
+    ("PUSH", 1, 0), "MSTORE",
+    # i = 0                                                   stack: [n, i]
+    ("PUSH", 1, 0),
+
+    ("LABEL", "loop"), "JUMPDEST",
+    # if !(i < n) goto end
+    "DUP2", "DUP2", "LT", "ISZERO", ("PUSH_LABEL", "end"), "JUMPI",
+    # mstore(4, calldataload(32 + 32 * i))
+    "DUP1", ("PUSH", 1, 5), "SHL", ("PUSH", 1, 0x20), "ADD", "CALLDATALOAD", ("PUSH", 1, 4), "MSTORE",
+    # ok = staticcall(gas, debtManager, 0, 0x24, 0, 0) && returndatasize >= 0x80
+    ("PUSH", 1, 0), ("PUSH", 1, 0), ("PUSH", 1, 0x24), ("PUSH", 1, 0),
+    ("PUSH", 1, 0), "CALLDATALOAD", "GAS", "STATICCALL",
+    "RETURNDATASIZE", ("PUSH", 1, 0x80), "GT", "ISZERO", "AND",
+    ("PUSH_LABEL", "good"), "JUMPI",
+    # 失敗：v = 0xFFFF                                        stack: [n, i, v]
+    ("PUSH", 2, LENS_FAILED), ("PUSH_LABEL", "store"), "JUMP",
+
+    ("LABEL", "good"), "JUMPDEST",
+    # 回傳的 head (ABI 的 4 個 flat 回傳值，同 USER_STATE_OUTPUT_TYPES)：[offset, totalCollateralInUsd, offset, totalBorrowings]
+    ("PUSH", 1, 0x20), ("PUSH", 1, 0x20), ("PUSH", 1, 0x40), "RETURNDATACOPY",
+    ("PUSH", 1, 0x20), ("PUSH", 1, 0x60), ("PUSH", 1, 0x60), "RETURNDATACOPY",
+    ("PUSH", 1, 0x40), "MLOAD",                                # stack: [n, i, c]
+    "DUP1", "ISZERO", ("PUSH_LABEL", "zero"), "JUMPI",
+    # v = debt * 10000 / c
+    ("PUSH", 2, 10000), ("PUSH", 1, 0x60), "MLOAD", "MUL", "DIV",  # stack: [n, i, v]
+    # v > 0xFFFE 時飽和
+    "DUP1", ("PUSH", 2, LENS_SATURATED), "LT", "ISZERO", ("PUSH_LABEL", "store"), "JUMPI",
+    "POP", ("PUSH", 2, LENS_SATURATED), ("PUSH_LABEL", "store"), "JUMP",
+
+    ("LABEL", "zero"), "JUMPDEST",
+    # 分母為 0，LTV 就是 0
+    "POP", ("PUSH", 1, 0),
+
+    ("LABEL", "store"), "JUMPDEST",
+    # p = OUT + 2 * i；mstore8(p, v >> 8)；mstore8(p + 1, v)
+    "DUP2", ("PUSH", 1, 1), "SHL", ("PUSH", 2, _OUT), "ADD",    # stack: [n, i, v, p]
+    "DUP2", ("PUSH", 1, 8), "SHR", "DUP2", "MSTORE8",
+    ("PUSH", 1, 1), "ADD", "MSTORE8",                            # stack: [n, i]
+    # i += 1
+    ("PUSH", 1, 1), "ADD", ("PUSH_LABEL", "loop"), "JUMP",
+
+    ("LABEL", "end"), "JUMPDEST",
+    # return(OUT, 2 * n)
+    "POP", ("PUSH", 1, 1), "SHL", ("PUSH", 2, _OUT), "RETURN",
+]
+
+LENS_RUNTIME_CODE = assemble(_LENS_PROGRAM)
+
+def deploy_code(runtime: bytes) -> bytes:
+    """把 runtime code 包成 init code (CODECOPY + RETURN)，測試時可直接部署到本地 EVM"""
+    # prefix 固定 13 bytes：copy code[13:] 到 memory 0 並 return
+    prefix = assemble([
+        ("PUSH", 2, len(runtime)), "DUP1", ("PUSH", 2, 13), ("PUSH", 1, 0), "CODECOPY",
+        ("PUSH", 1, 0), "RETURN",
+    ])
+    return prefix + runtime
+
+def encode_lens_calldata(debt_manager: str, safes: list[str]) -> bytes:
+    words = [debt_manager] + list(safes)
+    return b"".join(bytes.fromhex(addr[2:]).rjust(32, b"\x00") for addr in words)
+
+def decode_lens_result(raw: bytes, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    回傳 (ltv, ok)：ltv 為百分比 (float32，精度 0.01%；合約端整數除法為無條件捨去，
+    與 compute_ltv 的四捨五入最多差 0.01)，ok 為 False 的位置代表該 Safe 呼叫失敗。
+    """
+    if len(raw) != 2 * count:
+        raise ValueError(f"Unexpected lens response size: {len(raw)} bytes for {count} safes")
+    bps = np.frombuffer(raw, dtype=">u2")
+    ok = bps != LENS_FAILED
+    ltv = np.where(ok, bps / 100.0, -1.0).astype(np.float32)
+    return ltv, ok
+
+def call_lens(w3, debt_manager: str, safes: list[str], block_identifier="latest") -> bytes:
+    """
+    以 state override 執行 lens，回傳原始 bytes。
+
+    節點明確不支援 override 時拋出 LensUnsupported；其他 RPC 錯誤 (限流、逾時…) 原樣往上拋，由呼叫端重試。
+    """
+    tx = {"to": LENS_ADDRESS, "data": encode_lens_calldata(debt_manager, safes)}
+    override = {LENS_ADDRESS: {"code": LENS_RUNTIME_CODE}}
+    try:
+        return bytes(w3.eth.call(tx, block_identifier, override))
+    except Web3RPCError as e:
+        if is_override_unsupported(e):
+            raise LensUnsupported(str(e)) from e
+        raise
+    except TypeError as e:
+        # provider 本身不接受 override 參數 (例如 eth-tester)
+        raise LensUnsupported(str(e)) from e
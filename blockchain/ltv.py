@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+
+from eth_abi import decode
+from eth_utils.abi import get_abi_output_types
+
+from blockchain.abis import DEBT_MANAGER_ABI
+
+# getUserCurrentState 的回傳格式 (直接由 ABI 推出，與 web3 .call() 的解碼一致)：
+# 4 個獨立的回傳值 (token_data[], totalCollateral, token_data[], totalDebt)，不是包成單一 tuple。
+# 原始 bytes 的 head 為 [offset, totalCollateral, offset, totalDebt]，LTV lens 也依此讀取 0x20 / 0x60。
+USER_STATE_OUTPUT_TYPES = get_abi_output_types(
+    next(f for f in DEBT_MANAGER_ABI if f.get("name") == "getUserCurrentState")
+)
+
+def compute_ltv(total_collateral: int, total_debt: int) -> float:
+    """
+    LTV (%) = 負債 / 資產 * 100，四捨五入到小數第二位。
+
+    兩者單位都是 USD (例如 1e6 或 1e18)，直接相除單位會消掉。
+    分母為 0 時 LTV 就是 0。
+    """
+    if total_collateral == 0:
+        return 0.0
+    return round((total_debt / total_collateral) * 100, 2)
+
+def decode_user_state_ltv(return_data: bytes) -> float:
+    """把 getUserCurrentState 的原始回傳 bytes 解碼成 LTV"""
+    decoded_data = decode(USER_STATE_OUTPUT_TYPES, return_data)
+    # Index 1 是總資產 (USD), Index 3 是總負債 (USD)
+    return compute_ltv(decoded_data[1], decoded_data[3])
+
+# --- 批次查詢結果 ---
+
+# 每個地址的查詢狀態
+STATUS_OK = "ok"             # 第一次就成功
+STATUS_RETRIED = "retried"   # 重試後成功 (仍是最新資料)
+STATUS_STALE = "stale"       # 本輪 RPC 失敗，沿用上次成功的值
+STATUS_FAILED = "failed"     # 本輪 RPC 失敗且沒有可沿用的值
+STATUS_REVERTED = "reverted" # 節點正常，但呼叫 revert 或解碼失敗 (通常是無效的 Safe)
+
+FRESH_STATUSES = (STATUS_OK, STATUS_RETRIED)
+
+class BatchResult:
+    """
+    get_ltv_batch 的完整結果：除了 LTV 之外，也記錄每個地址的狀態，
+    讓呼叫端可以分辨「RPC 失敗」、「LTV 為 0」與「無效的 Safe」。
+    """
+
+    def __init__(self, block_identifier="latest"):
+        self.block_identifier = block_identifier
+        self.block_number = None  # 實際查詢的區塊高度 (無法取得時為 None)
+        self.ltv = {}     # addr -> LTV (%)；failed / reverted 為 -1.0
+        self.status = {}  # addr -> STATUS_*
+        self.as_of = {}   # addr -> 資料取得時間 (epoch)，stale 時為上次成功的時間
+
+    def set(self, addr: str, ltv: float, status: str, as_of: float):
+        self.ltv[addr] = ltv
+        self.status[addr] = status
+        self.as_of[addr] = as_of
+
+    def is_fresh(self, addr: str) -> bool:
+        return self.status.get(addr) in FRESH_STATUSES
+
+    def counts(self) -> dict[str, int]:
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    @property
+    def rpc_failed(self) -> bool:
+        """所有地址都沒有拿到新資料 (節點掛掉或 breaker 開啟)"""
+        return bool(self.status) and not any(s in FRESH_STATUSES or s == STATUS_REVERTED for s in self.status.values())
+
+    def as_ltv_map(self) -> dict[str, float]:
+        """
+        舊版 get_ltv_batch 的 dict 格式：revert 為 -1.0，stale 沿用舊值，
+        RPC 失敗的地址「不會出現在 dict 中」。
+        """
+        return {addr: ltv for addr, ltv in self.ltv.items() if self.status[addr] != STATUS_FAILED}
+
+    def snapshot_rows(self) -> list[dict]:
+        """轉成 upsert_ltv_snapshots 的格式；只保留本輪真正查到的結果 (不含 stale / failed)"""
+        return [
+            {
+                "safe_address": addr,
+                "ltv": ltv,
+                "status": self.status[addr],
+                "block_number": self.block_number,
+                "updated_at": datetime.fromtimestamp(self.as_of[addr], tz=timezone.utc).replace(tzinfo=None),
+            }
+            for addr, ltv in self.ltv.items()
+            if self.status[addr] in FRESH_STATUSES or self.status[addr] == STATUS_REVERTED
+        ]
@@ -0,0 +1,139 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("blockchain_resilience")
+
+class RPCError(Exception):
+    """RPC 呼叫失敗 (節點錯誤、逾時…)。與「地址無效」或「LTV 為 0」是不同的情況。"""
+
+class CircuitOpenError(RPCError):
+    """Circuit breaker 開啟中，直接失敗而不打節點"""
+
+class DeadlineExceeded(RPCError):
+    """超過本輪的 deadline，不再重試"""
+
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次後開啟 (open)，期間所有呼叫直接失敗；
+    reset_timeout 秒後進入 half-open，只放行一個試探呼叫，成功才關閉。
+    Fetcher 會在 executor 的多個執行緒中使用，所以狀態以 Lock 保護。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # half-open：同時間只允許一個試探呼叫
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def retry_after(self) -> float:
+        """距離下次可能放行還要等幾秒 (open 時等到 half-open；試探呼叫進行中時短暫輪詢)"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return 0.0
+            if self._state == self.OPEN:
+                remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    return remaining
+            return min(0.5, self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit breaker closed (RPC healthy again)")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"Circuit breaker opened after {self._failures} failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+class RetryPolicy:
+    """指數退避 + full jitter：第 n 次重試前等待 uniform(0, min(max_delay, base_delay * 2^n)) 秒"""
+
+    def __init__(self, attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+def call_with_retry(fn, policy: RetryPolicy, breaker: CircuitBreaker, deadline: float = None, fatal: tuple = ()):
+    """
+    執行 fn()，失敗時依 policy 重試。回傳 (結果, 重試次數)。
+
+    deadline 為 time.monotonic() 的絕對時間；下一次等待會超過 deadline 時就不再重試。
+    breaker 開啟時，有 deadline 的呼叫會等到 half-open 再試 (不消耗重試次數)，
+    等不到 (或沒有 deadline) 才拋出 CircuitOpenError。
+    fatal 中的例外 (例如合約 revert) 代表節點本身正常，不重試也不計入 breaker，直接往上拋。
+    全部失敗時拋出 RPCError。
+    """
+    last_error = None
+    for attempt in range(policy.attempts):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded(f"Deadline exceeded after {attempt} attempts") from last_error
+        while not breaker.allow():
+            wait = breaker.retry_after()
+            if deadline is None or time.monotonic() + wait >= deadline:
+                raise CircuitOpenError("Circuit breaker is open") from last_error
+            time.sleep(wait)
+
+        try:
+            result = fn()
+        except fatal:
+            breaker.record_success()
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            last_error = e
+            logger.warning(f"RPC attempt {attempt + 1}/{policy.attempts} failed: {e}")
+
+            if attempt + 1 >= policy.attempts:
+                break
+            delay = policy.backoff(attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise DeadlineExceeded(f"Deadline exceeded after {attempt + 1} attempts") from e
+            time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result, attempt
+
+    raise RPCError(f"RPC call failed after {policy.attempts} attempts: {last_error}") from last_error
@@ -0,0 +1,166 @@
+import numpy as np
+
+# 每個 monitor 的警報狀態 (存在 MonitorRegistry 的 "alert_state" 欄位)
+STATE_OK = 0          # 未超標
+STATE_ALERTING = 1    # 本輪剛發出警報
+STATE_COOLDOWN = 2    # 已警報過，仍在 cooldown 或落在 hysteresis 區間內
+STATE_ESCALATED = 3   # LTV 超過更高一級 (閾值 + escalation step)
+
+# Telegram 單則訊息的字數上限
+MESSAGE_LIMIT = 4096
+# 標題 (含 "(i/n)" 與 Safe 數) 與結尾提醒預留的字數
+_DIGEST_OVERHEAD = 120
+
+STATE_NAMES = {
+    STATE_OK: "ok",
+    STATE_ALERTING: "alerting",
+    STATE_COOLDOWN: "cooldown",
+    STATE_ESCALATED: "escalated",
+}
+
+def register_alert_columns(registry):
+    registry.register_column("alert_state", np.int8, STATE_OK)
+
+def warm_alert_state(registry, now: int, cooldown: int, saved: dict = None):
+    """
+    重啟後還原狀態：先套用 DB 中保存的狀態 (monitor_id -> state，保留 ESCALATED，
+    否則下一輪會重新升級並無視 cooldown 立即重發)；沒有保存狀態的 monitor
+    依 last_alert_at 判斷，cooldown 內警報過的視為 COOLDOWN，避免重啟後立刻重發一輪警報。
+    """
+    state = registry.column("alert_state")
+    for monitor_id, saved_state in (saved or {}).items():
+        row = registry.row_of(monitor_id)
+        if row is not None:
+            state[row] = saved_state
+    recent = (registry.last_alert_at > 0) & (now - registry.last_alert_at < cooldown)
+    state[recent & (state == STATE_OK)] = STATE_COOLDOWN
+
+def evaluate_alerts(
+    state: np.ndarray,
+    ltv: np.ndarray,
+    thresholds: np.ndarray,
+    last_alert_at: np.ndarray,
+    valid: np.ndarray,
+    now: int,
+    cooldown: int,
+    hysteresis: float,
+    escalation_step: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    對所有 monitor 一次計算狀態轉移，回傳 (new_state, send_mask)。
+
+    轉移規則 (依優先順序)：
+    1. 本輪沒有新資料 (valid=False)：狀態不變，不發送。
+    2. 非 OK 且 LTV < 閾值 - hysteresis：恢復為 OK。
+    3. LTV > 閾值 + escalation step 且尚未升級：ESCALATED，立即發送 (無視 cooldown)。
+    4. 已 ESCALATED 且仍未降到升級線 - hysteresis 以下：維持，cooldown 過了再提醒一次。
+    5. OK 且超過閾值：ALERTING，發送。
+    6. 其他非 OK 且超過閾值、cooldown 已過：ALERTING，再提醒一次。
+    7. 其他非 OK (cooldown 中或在 hysteresis 區間)：COOLDOWN，不發送。
+    8. 其餘維持 OK。
+    """
+    breach = ltv > thresholds
+    recovered = ltv < thresholds - hysteresis
+    escalation_line = thresholds + escalation_step
+    escalate = ltv > escalation_line
+    still_escalated = ltv >= escalation_line - hysteresis
+    cooled = now - last_alert_at >= cooldown
+
+    not_ok = state != STATE_OK
+    is_escalated = state == STATE_ESCALATED
+
+    conditions = [
+        ~valid,
+        not_ok & recovered,
+        escalate & ~is_escalated,
+        is_escalated & still_escalated,
+        ~not_ok & breach,
+        not_ok & breach & cooled,
+        not_ok,
+    ]
+    choice = np.select(conditions, np.arange(len(conditions)), default=len(conditions))
+
+    outcomes = np.array([
+        -1, # 保持原狀態 (下面另外處理)
+        STATE_OK,
+        STATE_ESCALATED,
+        STATE_ESCALATED,
+        STATE_ALERTING,
+        STATE_ALERTING,
+        STATE_COOLDOWN,
+        STATE_OK,
+    ], dtype=np.int8)
+    new_state = np.where(choice == 0, state, outcomes[choice]).astype(np.int8)
+
+    send = np.isin(choice, (2, 4, 5)) | ((choice == 3) & cooled)
+    return new_state, send
+
+def group_by_chat(chat_ids: np.ndarray, rows: np.ndarray) -> list[tuple[int, np.ndarray]]:
+    """把要發送的 rows 依 chat id 分組，每個 chat 一則 digest"""
+    if not len(rows):
+        return []
+    order = rows[np.argsort(chat_ids[rows], kind="stable")]
+    bounds = np.flatnonzero(np.diff(chat_ids[order])) + 1
+    return [(int(chat_ids[group[0]]), group) for group in np.split(order, bounds)]
+
+def _alert_line(entry) -> str:
+    addr, ltv, threshold, state = entry
+    tag = "[ESCALATED]" if state == STATE_ESCALATED else "[ALERT]"
+    return f"{tag} {addr[:6]}...{addr[-4:]}: {ltv:.2f}% LTV (threshold {threshold:g}%)"
+
+def _early_line(entry) -> str:
+    addr, ltv, threshold, eta = entry
+    return (
+        f"[EARLY] {addr[:6]}...{addr[-4:]}: {ltv:.2f}% LTV, "
+        f"threshold {threshold:g}% in ~{max(1, round(eta / 60))}m at current trend"
+    )
+
+def split_digest(entries: list, early: list = (), limit: int = MESSAGE_LIMIT) -> list[tuple[list, list]]:
+    """
+    把一個 chat 的 digest 依序切成多段 [(entries, early), ...]，
+    每段用 format_digest(..., part=(i, n)) 排版後都不超過 limit 字。
+    """
+    budget = limit - _DIGEST_OVERHEAD
+    parts = [([], [])]
+    used = 0
+    for kind, items, line in ((0, entries, _alert_line), (1, early, _early_line)):
+        for entry in items:
+            size = len(line(entry)) + 1
+            if used + size > budget and (parts[-1][0] or parts[-1][1]):
+                parts.append(([], []))
+                used = 0
+            parts[-1][kind].append(entry)
+            used += size
+    return parts
+
+def format_digest(
+    entries: list[tuple[str, float, float, int]],
+    early: list[tuple[str, float, float, float]] = (),
+    part: tuple[int, int] = None,
+) -> str:
+    """
+    entries: [(address, ltv, threshold, state), ...]
+    early: [(address, ltv, threshold, eta_seconds), ...] 依趨勢預估即將超標的 Safe
+    同一個 chat 本輪所有需要通知的 Safe 合併成一則訊息；
+    太長時由 split_digest 切段，part=(i, n) 標在標題上。
+    """
+    escalated = any(state == STATE_ESCALATED for _, _, _, state in entries)
+    if escalated:
+        title = "🚨 LTV Alert (escalated)"
+    elif entries:
+        title = "⚠️ LTV Alert"
+    else:
+        title = "⏳ LTV Early Warning"
+    total = len(entries) + len(early)
+    if total > 1:
+        title += f" - {total} safes"
+    if part and part[1] > 1:
+        title += f" ({part[0]}/{part[1]})"
+
+    lines = [title, ""]
+    lines.extend(_alert_line(entry) for entry in entries)
+    lines.extend(_early_line(entry) for entry in early)
+
+    lines.append("")
+    lines.append("Please take action to reduce your leverage.")
+    return "\n".join(lines)
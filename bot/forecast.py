@@ -0,0 +1,141 @@
+import numpy as np
+
+from db.registry import to_epoch
+
+# 每個 row 最小平方法所需的累計量：點數、Σx、Σy、Σx²、Σxy (x 為相對於 trend_origin 的區塊數)
+_SUMS = ("trend_n", "trend_sx", "trend_sy", "trend_sxx", "trend_sxy")
+
+def register_forecast_columns(registry, window: int):
+    """
+    每個 monitor 保留最近 window 個 (block, LTV) 點的 ring buffer，
+    以及這些點的累計量 (在 record_points 中增量更新)，讓每輪的擬合只剩幾個 1D 向量運算。
+    另外記錄上次發出預警的時間。
+    """
+    registry.register_column("ltv_window", np.float64, 0.0, shape=(window,))
+    registry.register_column("block_window", np.int64, 0, shape=(window,))
+    registry.register_column("window_slot", np.int64, 0)  # ring buffer 下一個要寫入的位置 (視窗內點數即 trend_n)
+    registry.register_column("trend_origin", np.int64, 0)  # 累計量的 x 原點 = 最新一個點的區塊
+    for name in _SUMS:
+        registry.register_column(name, np.float64, 0.0)
+    registry.register_column("last_prealert_at", np.int64, 0)
+
+def warm_prealerts(registry, sent_at: dict):
+    """重啟後依 DB 還原上次預警時間 (monitor_id -> datetime)，cooldown 內不會重發"""
+    column = registry.column("last_prealert_at")
+    for monitor_id, at in sent_at.items():
+        row = registry.row_of(monitor_id)
+        if row is not None:
+            column[row] = to_epoch(at)
+
+def record_points(registry, rows: np.ndarray, block_number: int, ltv: np.ndarray):
+    """
+    把本輪查到的點寫入 rows 的 ring buffer (rows 遞增、ltv 與 rows 對齊)，並更新累計量：
+    先把原點平移到新點的區塊 (x 只會落在視窗跨度內，數值不會隨時間變大)，
+    再扣掉被覆蓋的最舊點、加上新點 (新點 x = 0，只影響點數與 Σy)。
+    """
+    if not len(rows):
+        return
+    ltv_window = registry.column("ltv_window")
+    block_window = registry.column("block_window")
+    window = ltv_window.shape[1]
+
+    # 所有 row 都有新點時 (例如整輪都到期) 直接在欄位上原地運算，省掉 gather / scatter
+    index = slice(None) if len(rows) == len(registry) else rows
+    slot = registry.column("window_slot")[index]
+    origin = registry.column("trend_origin")[index]
+    n, sx, sy, sxx, sxy = (registry.column(name)[index] for name in _SUMS)
+
+    # 平移原點：x' = x - d  =>  Σx² += (n·d - 2Σx)·d、Σxy -= d·Σy、Σx -= n·d
+    d = np.subtract(block_number, origin, dtype=np.float64)
+    scratch = n * d
+    scratch -= sx
+    scratch -= sx
+    scratch *= d
+    sxx += scratch
+    np.multiply(d, sy, out=scratch)
+    sxy -= scratch
+    np.multiply(n, d, out=scratch)
+    sx -= scratch
+
+    # 視窗已滿時扣掉即將被覆蓋的點 (ring buffer 以攤平後的索引存取，避免 2D fancy indexing)
+    flat = rows * window
+    flat += slot
+    full = n >= window
+    old_x = np.take(block_window, flat)
+    old_x -= block_number
+    old_x = old_x.astype(np.float64)
+    old_x *= full
+    old_y = np.take(ltv_window, flat)
+    old_y *= full
+
+    n += 1
+    n -= full
+    sx -= old_x
+    sy += ltv
+    sy -= old_y
+    np.multiply(old_x, old_x, out=scratch)
+    sxx -= scratch
+    old_x *= old_y
+    sxy -= old_x
+
+    np.put(ltv_window, flat, ltv)
+    np.put(block_window, flat, block_number)
+    slot += 1
+    slot *= slot < window  # 繞回 0 (比 % 快)
+    origin[...] = block_number
+    if index is rows:
+        registry.column("window_slot")[rows] = slot
+        registry.column("trend_origin")[rows] = origin
+        for name, values in zip(_SUMS, (n, sx, sy, sxx, sxy)):
+            registry.column(name)[rows] = values
+
+def fit_trend(registry, min_points: int) -> np.ndarray:
+    """
+    對所有 row 的視窗做最小平方法直線擬合，回傳斜率 (LTV % / block)。
+
+    slope = (n·Σxy - Σx·Σy) / (n·Σx² - (Σx)²)，累計量已由 record_points 維護好，
+    這裡只剩幾個 1D 運算。點數不足 min_points 或區塊都相同時斜率為 0。
+    """
+    n, sx, sy, sxx, sxy = (registry.column(name) for name in _SUMS)
+    denominator = n * sxx
+    scratch = sx * sx
+    denominator -= scratch
+    numerator = n * sxy
+    np.multiply(sx, sy, out=scratch)
+    numerator -= scratch
+
+    # 無效的 row 分子歸零、分母墊成最小正數，整個向量直接相除 (不用 where=，遮罩運算在大陣列上較慢)
+    valid = n >= min_points
+    valid &= denominator > 0
+    numerator *= valid
+    np.maximum(denominator, np.finfo(np.float64).tiny, out=denominator)
+    numerator /= denominator
+    return numerator
+
+def time_to_threshold(ltv: np.ndarray, thresholds: np.ndarray, slope: np.ndarray, block_time: float) -> np.ndarray:
+    """
+    依目前 LTV 與斜率推估多久後會超過閾值 (秒)。
+
+    已超過閾值為 0；LTV 未上升或沒有有效資料 (ltv < 0) 為 inf。
+    """
+    # 全部用逐元素運算 (無遮罩)：斜率 <= 0 或沒有資料的速率歸零，gap / 0 = inf；
+    # 已超過閾值的 gap <= 0，除出來是負數、-inf 或 nan，fmax 一律變成 0
+    # (ltv < 0 時 gap 必為正，速率歸零後即為 inf)
+    gap = np.subtract(thresholds, ltv, dtype=np.float64)
+    gap *= block_time
+    rate = np.maximum(slope, 0.0)
+    rate *= ltv >= 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gap /= rate
+    np.fmax(gap, 0.0, out=gap)
+    return gap
+
+def schedule_next_check(eta: np.ndarray, now: int, min_interval: int, max_interval: int) -> np.ndarray:
+    """
+    下次檢查時間：預估剩餘時間的一半，夾在 [min_interval, max_interval]。
+    LTV 爬升越快的 Safe 檢查越頻繁；穩定的維持原本的間隔。
+    """
+    interval = eta * 0.5
+    np.clip(interval, min_interval, max_interval, out=interval)
+    interval += now
+    return interval.astype(np.int64)
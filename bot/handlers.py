@@ -1,11 +1,16 @@
 import asyncio
+from datetime import datetime
 from telegram import Update
 from telegram.ext import ContextTypes
+from web3 import Web3
 
+import config
 from logs.logger import setup_logger
 from blockchain.fetcher import Fetcher
+from blockchain.ltv import STATUS_REVERTED
+from blockchain.resilience import RPCError
 from db import SessionLocal
-from db.crud import add_monitor, get_user_monitors, create_user, delete_monitor, get_all_active_monitors, update_last_alert
+from db.crud import add_monitor, get_user_monitors, create_user, delete_monitor, get_all_active_monitors, update_last_alert, get_ltv_snapshots, upsert_ltv_snapshots
 
 # 初始化 Logger
 logger = setup_logger("bot_handlers", "./logs")
@@ -19,6 +24,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Commands:\n"
         "/add <address> - Monitor an address\n"
         "/list - View your monitored addresses\n"
+        "/list refresh - Fetch live data for outdated entries\n"
         "/remove <address> - Stop monitoring an address\n"
         "This monitor checks LTV every hour and alerts you if it exceeds safe limits."
     )
@@ -56,7 +62,12 @@ async def add_address_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         # 2. 區塊鏈驗證 (關鍵修正：避免阻塞 Main Thread)
         # run_in_executor(None, ...) 會使用預設的 ThreadPoolExecutor
         # is_safe 是同步函式，必須丟到執行緒中跑，否則 Bot 會凍結
-        is_valid_safe = await loop.run_in_executor(None, Fetcher.is_safe, target_address)
+        try:
+            is_valid_safe = await loop.run_in_executor(None, Fetcher.is_safe, target_address)
+        except RPCError:
+            # 節點問題，不能當成「地址無效」回覆
+            await update.message.reply_text("The blockchain node is temporarily unavailable. Please try again later.")
+            return
 
         if not is_valid_safe:
             logger.warning(f"Address {target_address} validation failed for user {user_id}")
@@ -85,16 +96,27 @@ async def add_address_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     finally:
         db.close()
 
+def _format_age(seconds: float) -> str:
+    if seconds < 60:
+        return "just now"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}m ago"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)}h ago"
+    return f"{int(seconds // 86400)}d ago"
+
 async def list_monitors_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    處理 /list 指令。
+    處理 /list [refresh] 指令。
     
     流程：
     1. 從資料庫讀取該用戶的監控清單。
-    2. 批次查詢區塊鏈上的最新 LTV。
-    3. 格式化輸出。
+    2. 從 ltv_snapshots 讀取 monitor loop 最近一次查到的 LTV (不打鏈)。
+    3. 若指定 refresh，僅對快照已超過 LIST_REFRESH_MIN_AGE_SECONDS 的地址即時查鏈並寫回快照。
+    4. 格式化輸出 (附上資料新鮮度)。
     """
     user_id = update.effective_user.id
+    refresh = bool(context.args) and context.args[0].lower() == "refresh"
     
     db = SessionLocal()
 
@@ -108,26 +130,68 @@ async def list_monitors_handler(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("You are not monitoring any addresses.")
             return
 
-        await update.message.reply_text(f"Fetching data for {len(monitors)} addresses...")
+        # 提取地址列表 (快照以 checksum 格式為 key)
+        addresses = list(dict.fromkeys(Web3.to_checksum_address(m.safe_address) for m in monitors))
+
+        # 2. 讀取快照
+        snapshots = await loop.run_in_executor(None, get_ltv_snapshots, db, addresses)
+        now = datetime.utcnow()
 
-        # 提取地址列表
-        addresses = [m.safe_address for m in monitors]
+        def age_of(addr):
+            snapshot = snapshots.get(addr)
+            return None if snapshot is None else (now - snapshot.updated_at).total_seconds()
 
-        # 2. 批次查詢 LTV (使用 Multicall 避免多次請求)
-        ltv_data = await loop.run_in_executor(None, Fetcher.get_ltv_batch, addresses)
+        outdated = [
+            addr for addr in addresses
+            if age_of(addr) is None or age_of(addr) > config.LIST_REFRESH_MIN_AGE_SECONDS
+        ]
 
-        # 3. 格式化訊息
+        # 3. 選擇性即時刷新 (只刷新過舊的地址)
+        failed = set()
+        if refresh and outdated:
+            await update.message.reply_text(f"Refreshing live data for {len(outdated)} addresses...")
+            batch = await loop.run_in_executor(None, Fetcher.fetch_ltv_batch, outdated)
+            await loop.run_in_executor(None, upsert_ltv_snapshots, db, batch.snapshot_rows())
+
+            failed = {addr for addr in outdated if not batch.is_fresh(addr) and batch.status[addr] != STATUS_REVERTED}
+            snapshots = await loop.run_in_executor(None, get_ltv_snapshots, db, addresses)
+            now = datetime.utcnow()
+
+        # 4. 格式化訊息
         message_lines = ["Your Watchlist:", ""]
         
-        for addr, ltv_value in ltv_data.items():
+        for addr in addresses:
+            # 顯示地址前6後4碼
+            short_addr = f"{addr[:6]}...{addr[-4:]}"
+            snapshot = snapshots.get(addr)
+
+            if snapshot is None:
+                message_lines.append(f"[....] {short_addr}: pending first check")
+                continue
+            if snapshot.status == STATUS_REVERTED:
+                message_lines.append(f"[????] {short_addr}: no position data")
+                continue
+
+            ltv_value = snapshot.ltv
             # 簡單的狀態標記 [SAFE], [WARN], [RISK]
             status = "[SAFE]"
             if ltv_value > 80: status = "[WARN]"
             if ltv_value > 90: status = "[RISK]"
 
-            # 顯示地址前6後4碼
-            short_addr = f"{addr[:6]}...{addr[-4:]}"
-            message_lines.append(f"{status} {short_addr}: {ltv_value:.2f}% LTV")
+            line = f"{status} {short_addr}: {ltv_value:.2f}% LTV ({_format_age(age_of(addr))}"
+            if snapshot.block_number is not None:
+                line += f", block {snapshot.block_number}"
+            line += ")"
+            if addr in failed:
+                line += " - refresh failed (RPC error)"
+            message_lines.append(line)
+
+        if not refresh and outdated:
+            message_lines.append("")
+            message_lines.append(
+                f"Send /list refresh to fetch live data for {len(outdated)} entries "
+                f"older than {config.LIST_REFRESH_MIN_AGE_SECONDS // 60} minutes."
+            )
 
         await update.message.reply_text("\n".join(message_lines))
 
@@ -1,10 +1,27 @@
 import asyncio
+import time
 from datetime import datetime
+
+import numpy as np
+from web3 import Web3
 from telegram.ext import Application
+
+import config
 from logs.logger import setup_logger
 from blockchain.fetcher import Fetcher
 from db import SessionLocal
-from db.crud import get_all_active_monitors, update_last_alert
+from blockchain.ltv import STATUS_FAILED, STATUS_STALE
+from db.crud import (
+    update_last_alerts, upsert_ltv_snapshots, get_ltv_snapshots, save_alert_states, get_alert_states,
+    record_prealerts, get_prealerts,
+)
+from db.registry import MonitorRegistry, from_epoch, to_epoch
+from bot.alerts import (
+    STATE_OK, register_alert_columns, warm_alert_state, evaluate_alerts, group_by_chat, split_digest, format_digest
+)
+from bot.forecast import (
+    register_forecast_columns, warm_prealerts, record_points, fit_trend, time_to_threshold, schedule_next_check
+)
 
 # 初始化 Logger
 logger = setup_logger("monitor_loop", "./logs")
@@ -12,100 +29,266 @@ logger = setup_logger("monitor_loop", "./logs")
 # 全域變數儲存 application 實例
 app_instance = None
 
+# 常駐的 monitor 表，跨輪次保留，只套用 DB 差量
+registry = MonitorRegistry()
+register_alert_columns(registry)
+# 最近一次查到的 LTV 與排程狀態 (重啟時由 ltv_snapshots 還原)
+registry.register_column("last_ltv", np.float32, -1.0)
+registry.register_column("last_checked_at", np.int64, 0)
+registry.register_column("next_check_at", np.int64, 0)
+# 最近幾個 (block, LTV) 點，用來推估趨勢與超標時間
+register_forecast_columns(registry, config.FORECAST_WINDOW)
+
+def _near_threshold(ltv: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """LTV 在閾值下方 NEAR_THRESHOLD_MARGIN 以內 (或已超標)；沒有資料 (ltv < 0) 不算"""
+    return (ltv >= 0) & (ltv >= thresholds - config.NEAR_THRESHOLD_MARGIN)
+
+def _warm_from_snapshots(db):
+    """
+    重啟後從 ltv_snapshots 還原每個 monitor 的最新 LTV 與下次檢查時間，
+    最近才查過、離閾值還遠的 Safe 不必在第一輪重新掃描。
+    """
+    addresses, inverse = registry.unique_addresses()
+    checksum_addrs = [Web3.to_checksum_address(a) for a in addresses]
+    snapshots = get_ltv_snapshots(db, checksum_addrs)
+    if not snapshots:
+        return
+
+    unique_ltv = np.full(len(checksum_addrs), -1.0, dtype=np.float32)
+    unique_checked = np.zeros(len(checksum_addrs), dtype=np.int64)
+    unique_block = np.zeros(len(checksum_addrs), dtype=np.int64)
+    for i, addr in enumerate(checksum_addrs):
+        snapshot = snapshots.get(addr)
+        if snapshot is not None:
+            unique_ltv[i] = snapshot.ltv
+            unique_checked[i] = to_epoch(snapshot.updated_at)
+            unique_block[i] = snapshot.block_number or 0
+
+    checked = unique_checked[inverse]
+    has_snapshot = checked > 0
+    registry.column("last_ltv")[:] = unique_ltv[inverse]
+    registry.column("last_checked_at")[:] = checked
+    registry.column("next_check_at")[:] = np.where(has_snapshot, checked + config.MONITOR_INTERVAL_SECONDS, 0)
+
+    # 趨勢視窗重啟後只剩一個點 (eta 為 inf)，接近閾值或尚未恢復 OK 的 monitor 第一輪就檢查，
+    # 不沿用一般間隔 (原本可能每個 tick 都在檢查)
+    urgent = (registry.column("alert_state") != STATE_OK) | _near_threshold(registry.column("last_ltv"), registry.thresholds)
+    registry.column("next_check_at")[urgent] = 0
+
+    # 快照當作趨勢視窗的第一個點
+    blocks = unique_block[inverse]
+    seed_rows = np.flatnonzero((blocks > 0) & (registry.column("last_ltv") >= 0))
+    for block in np.unique(blocks[seed_rows]):
+        rows = seed_rows[blocks[seed_rows] == block]
+        record_points(registry, rows, int(block), registry.column("last_ltv")[rows])
+
+    logger.info(f"Warmed {int(has_snapshot.sum())}/{len(registry)} monitors from LTV snapshots")
+
 async def monitor_ltv_check():
     """
-    後台監控迴圈：每 5 分鐘檢查一次所有監控地址的 LTV。
+    後台監控迴圈：定期檢查所有監控地址的 LTV。
     
     邏輯：
-    1. 從資料庫抓出所有 is_active = True 的監控。
-    2. 批次查詢區塊鏈上的最新 LTV。
-    3. 如果 LTV 超過警報閾值，發送警告。
-    4. 更新上次警報時間。
+    1. 將常駐的 MonitorRegistry 與資料庫同步 (只套用差量)。
+    2. 對已到期 (next_check_at) 的去重地址批次查詢區塊鏈上的最新 LTV。
+    3. 將結果批次寫入 ltv_snapshots。
+    4. 以最近幾個點擬合 LTV 趨勢，推估超標時間並據此排定下次檢查。
+    5. 一次計算所有 monitor 的警報狀態 (hysteresis / cooldown / 升級) 與趨勢預警。
+    6. 每個用戶合併成一則 digest 發送，並以單一 UPDATE 寫回上次警報時間。
     
-    頻率：5 分鐘
+    頻率：每 MONITOR_TICK_SECONDS 執行一次；每個 Safe 最多間隔 MONITOR_INTERVAL_SECONDS 檢查一次，
+    LTV 逼近閾值時依預估時間縮短到最快每個 tick 一次
     """
     if not app_instance:
         logger.warning("app_instance not set, skipping monitor check")
         return
 
+    db = SessionLocal()
     try:
-        db = SessionLocal()
-        monitors = get_all_active_monitors(db)
+        first_load = not registry.loaded_at
+        full = time.time() - registry.loaded_at >= config.REGISTRY_FULL_RESYNC_SECONDS
+        upserted, removed = registry.sync(db, full=full)
+        if upserted or removed:
+            logger.info(f"Registry synced (full={full}): +{upserted} / -{removed}, seq={registry.synced_seq}")
+        if first_load:
+            warm_alert_state(registry, int(time.time()), config.ALERT_COOLDOWN_SECONDS, get_alert_states(db))
+            _warm_from_snapshots(db)
+            warm_prealerts(registry, get_prealerts(db))
 
-        if not monitors:
+        if not len(registry):
             logger.debug("No active monitors to check")
-            db.close()
             return
 
-        logger.info(f"Starting LTV check for {len(monitors)} monitors")
+        # 只掃描已到期的 monitor
+        now = int(time.time())
+        due_rows = np.flatnonzero(registry.column("next_check_at") <= now)
+        if not len(due_rows):
+            logger.debug("No monitors due for a check")
+            return
+
+        logger.info(f"Starting LTV check for {len(due_rows)}/{len(registry)} monitors")
+
+        # 批次獲取到期地址的 LTV (同一個 Safe 只查一次)
+        addresses, inverse = registry.unique_addresses(due_rows)
+        checksum_addrs = [Web3.to_checksum_address(a) for a in addresses]
+        batch = await asyncio.get_running_loop().run_in_executor(
+            None, Fetcher.fetch_ltv_batch, checksum_addrs
+        )
+
+        if batch.rpc_failed:
+            logger.warning(f"RPC unavailable, skipping alert evaluation this cycle: {batch.counts()}")
+            return
+
+        # 只用最新資料判斷警報；未到期、stale、失敗的 monitor 不參與狀態轉移
+        unique_ltv = np.fromiter(
+            (batch.ltv[a] for a in checksum_addrs), dtype=np.float32, count=len(checksum_addrs)
+        )
+        unique_fresh = np.fromiter(
+            (batch.is_fresh(a) for a in checksum_addrs), dtype=bool, count=len(checksum_addrs)
+        )
+        unique_done = np.fromiter(
+            (batch.status[a] != STATUS_FAILED and batch.status[a] != STATUS_STALE for a in checksum_addrs),
+            dtype=bool, count=len(checksum_addrs)
+        )
+
+        last_ltv = registry.column("last_ltv")
+        ltv = last_ltv.copy()
+        ltv[due_rows] = unique_ltv[inverse]
+        fresh = np.zeros(len(registry), dtype=bool)
+        fresh[due_rows] = unique_fresh[inverse]
 
-        # 按用戶分組監控地址
-        user_monitors = {}
-        for monitor in monitors:
-            user_id = monitor.owner.telegram_id
-            if user_id not in user_monitors:
-                user_monitors[user_id] = []
-            user_monitors[user_id].append(monitor)
+        done_rows = due_rows[unique_done[inverse]]
+        last_ltv[done_rows] = ltv[done_rows]
+        registry.column("last_checked_at")[done_rows] = now
+
+        # 新鮮的點寫入趨勢視窗，再對所有 monitor 一次擬合斜率並推估超標時間
+        if batch.block_number is not None:
+            record_points(registry, np.flatnonzero(fresh), batch.block_number, ltv[fresh])
+        slope = fit_trend(registry, config.FORECAST_MIN_POINTS)
+        eta = time_to_threshold(last_ltv, registry.thresholds, slope, config.BLOCK_TIME_SECONDS)
+
+        # 有結果 (含 revert，eta 為 inf) 的依預估時間排程，失敗的下個 tick 再試
+        next_check = schedule_next_check(
+            eta[done_rows], now, config.MONITOR_TICK_SECONDS, config.MONITOR_INTERVAL_SECONDS
+        )
+        # 點數還不夠估斜率 (新加入或剛重啟) 但已接近閾值的，先每個 tick 檢查直到趨勢建立
+        unfitted = registry.column("trend_n")[done_rows] < config.FORECAST_MIN_POINTS
+        unfitted &= _near_threshold(last_ltv[done_rows], registry.thresholds[done_rows])
+        next_check[unfitted] = now + config.MONITOR_TICK_SECONDS
+        registry.column("next_check_at")[done_rows] = next_check
 
-        # 批次獲取所有地址的 LTV
-        all_addresses = [m.safe_address for m in monitors]
-        ltv_data = await asyncio.get_running_loop().run_in_executor(
-            None, Fetcher.get_ltv_batch, all_addresses
+        # 一次計算所有 monitor 的警報狀態轉移
+        alert_state = registry.column("alert_state")
+        previous_state = alert_state.copy()
+        new_state, send = evaluate_alerts(
+            alert_state, ltv, registry.thresholds, registry.last_alert_at, fresh, now,
+            config.ALERT_COOLDOWN_SECONDS, config.ALERT_HYSTERESIS, config.ALERT_ESCALATION_STEP,
         )
+        alert_state[:] = new_state
+
+        send_rows = np.flatnonzero(send)
+
+        # 尚未超標、但依趨勢會在 horizon 內超標的 monitor 先發預警 (有自己的 cooldown)
+        last_prealert_at = registry.column("last_prealert_at")
+        early = (
+            (new_state == STATE_OK) & fresh & (eta > 0) & (eta <= config.PREALERT_HORIZON_SECONDS)
+            & (now - last_prealert_at >= config.ALERT_COOLDOWN_SECONDS)
+        ) if config.PREALERT_ENABLED else np.zeros(len(registry), dtype=bool)
+        early_rows = np.flatnonzero(early)
+
+        logger.info(
+            f"{int(registry.breaching(ltv)[due_rows].sum())} checked monitors above threshold, "
+            f"{len(send_rows)} alerts and {len(early_rows)} early warnings to send (fetch: {batch.counts()})"
+        )
+
+        # row -> 該 row 在本輪查詢中的地址
+        position = np.full(len(registry), -1, dtype=np.int64)
+        position[due_rows] = inverse
 
-        # 檢查每個監控並發送警告
-        for user_id, user_monitor_list in user_monitors.items():
-            for monitor in user_monitor_list:
-                addr = monitor.safe_address
-                ltv = ltv_data.get(addr, -1.0)
-
-                # 檢查是否超過閾值
-                if ltv > monitor.alert_threshold:
-                    try:
-                        # 發送警告訊息
-                        short_addr = f"{addr[:6]}...{addr[-4:]}"
-                        message = (
-                            f"⚠️ LTV Alert\n\n"
-                            f"Address: {short_addr}\n"
-                            f"Current LTV: {ltv:.2f}%\n"
-                            f"Threshold: {monitor.alert_threshold}%\n\n"
-                            f"Please take action to reduce your leverage."
-                        )
-                        
-                        await app_instance.bot.send_message(
-                            chat_id=int(user_id),
-                            text=message
-                        )
-                        
-                        logger.info(
-                            f"Sent alert to user {user_id} for address {addr} "
-                            f"(LTV: {ltv:.2f}%)"
-                        )
-                        
-                        # 更新上次警報時間
-                        update_last_alert(db, monitor.id)
-
-                    except Exception as e:
-                        logger.error(
-                            f"Failed to send alert to user {user_id}: {e}",
-                            exc_info=True
-                        )
-                else:
-                    logger.debug(
-                        f"Monitor {addr}: LTV {ltv:.2f}% (threshold: {monitor.alert_threshold}%)"
+        # 同一個 chat 合併成一則 digest
+        alerted_rows = []
+        warned_rows = []
+        notify_rows = np.flatnonzero(send | early)
+        for chat_id, rows in group_by_chat(registry.chat_ids, notify_rows):
+            alert_rows = rows[send[rows]]
+            warn_rows = rows[early[rows]]
+            entries = [
+                (checksum_addrs[position[row]], float(ltv[row]), float(registry.thresholds[row]), int(new_state[row]))
+                for row in alert_rows
+            ]
+            early_entries = [
+                (checksum_addrs[position[row]], float(ltv[row]), float(registry.thresholds[row]), float(eta[row]))
+                for row in warn_rows
+            ]
+            # 超過 Telegram 字數上限時分成多則，各自送出
+            parts = split_digest(entries, early_entries)
+            alert_start = warn_start = 0
+            for index, (part_entries, part_early) in enumerate(parts, 1):
+                part_alert_rows = alert_rows[alert_start:alert_start + len(part_entries)]
+                part_warn_rows = warn_rows[warn_start:warn_start + len(part_early)]
+                alert_start += len(part_entries)
+                warn_start += len(part_early)
+                try:
+                    await app_instance.bot.send_message(
+                        chat_id=chat_id,
+                        text=format_digest(part_entries, part_early, part=(index, len(parts)))
+                    )
+                    if len(part_alert_rows):
+                        alerted_rows.append(part_alert_rows)
+                    if len(part_warn_rows):
+                        warned_rows.append(part_warn_rows)
+                    logger.info(
+                        f"Sent alert digest {index}/{len(parts)} to user {chat_id} "
+                        f"for {len(part_alert_rows) + len(part_warn_rows)} safes"
                     )
 
-        db.close()
+                except Exception as e:
+                    # 沒送出去就不算警報過：只有這則訊息內的狀態退回 OK，下一輪會再嘗試
+                    alert_state[part_alert_rows] = STATE_OK
+                    logger.error(
+                        f"Failed to send alert {index}/{len(parts)} to user {chat_id}: {e}",
+                        exc_info=True
+                    )
+
+        # 更新上次警報時間 (單一 UPDATE)
+        if alerted_rows:
+            rows = np.concatenate(alerted_rows)
+            registry.mark_alerted(rows, now)
+            update_last_alerts(db, registry.monitor_ids[rows], from_epoch(now))
+
+        # 狀態有變的 monitor 寫回 DB (送出失敗而退回的不算)，重啟後才能還原 ESCALATED
+        changed_rows = np.flatnonzero(alert_state != previous_state)
+        if len(changed_rows):
+            save_alert_states(db, registry.monitor_ids[changed_rows], alert_state[changed_rows], from_epoch(now))
+
+        # 預警時間同樣寫回 DB，重啟後不會重發 cooldown 內的預警
+        if warned_rows:
+            rows = np.concatenate(warned_rows)
+            last_prealert_at[rows] = now
+            record_prealerts(db, registry.monitor_ids[rows], from_epoch(now))
+
+        # 本輪查到的結果寫入快照表 (/list 與重啟時使用)；放在警報送出之後、丟到 executor，
+        # 寫入失敗只記錄，不影響本輪警報，也不阻塞 Telegram handlers
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, upsert_ltv_snapshots, db, batch.snapshot_rows()
+            )
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to write LTV snapshots: {e}", exc_info=True)
+
         logger.info(f"Completed LTV check at {datetime.utcnow().isoformat()}")
 
     except Exception as e:
         logger.error(f"Error in monitor_ltv_check: {e}", exc_info=True)
+    finally:
+        db.close()
 
 
 def setup_monitor_scheduler(application: Application):
     """
     設置監控迴圈排程。
-    每 5 分鐘執行一次 LTV 檢查。
+    每個 tick 執行一次，只檢查已到期的 Safe。
     
     Args:
         application: Telegram Application 實例
@@ -114,16 +297,18 @@ def setup_monitor_scheduler(application: Application):
     app_instance = application
 
     # 使用 application 的 job_queue 來排程任務
-    # 5 分鐘 = 300 秒
     job_queue = application.job_queue
     job_queue.run_repeating(
         callback=_scheduler_callback,
-        interval=3600,  # 1 小時
+        interval=config.MONITOR_TICK_SECONDS,
         first=30,      # 延遲 30 秒後開始執行（讓機器人完全初始化）
         name="ltv_monitor_loop"
     )
 
-    logger.info("LTV monitor scheduler set up (1 hour interval)")
+    logger.info(
+        f"LTV monitor scheduler set up ({config.MONITOR_TICK_SECONDS}s tick, "
+        f"{config.MONITOR_INTERVAL_SECONDS}s per-safe interval)"
+    )
 
 
 async def _scheduler_callback(context):
@@ -8,4 +8,57 @@ DEBT_MANAGER_ADDR = os.getenv("DEBT_MANAGER_ADDR")
 ETHERFI_DATA_PROVIDER_ADDR = os.getenv("ETHERFI_DATA_PROVIDER_ADDR")
 MULTICALL3_ADDR = "0xcA11bde05977b3631167028862bE2a173976CA11"
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-DATABASE_URL = os.getenv("DATABASE_URL")
\ No newline at end of file
+DATABASE_URL = os.getenv("DATABASE_URL")
+# Monitor loop
+# MonitorRegistry 平常只拉差量，每隔這段時間整表重載一次作為保險
+REGISTRY_FULL_RESYNC_SECONDS = int(os.getenv("REGISTRY_FULL_RESYNC_SECONDS", "21600"))
+# 差量同步時往回重讀的 seq 數：Postgres 上 seq 較小的交易可能較晚 commit，
+# 重讀這段視窗才不會漏掉，而不必等下一次整表重載
+REGISTRY_SYNC_LOOKBACK = int(os.getenv("REGISTRY_SYNC_LOOKBACK", "200"))
+
+# RPC resilience
+# Multicall 每批的地址數；批次之間獨立重試，一批失敗不會拖垮整輪
+MULTICALL_CHUNK_SIZE = int(os.getenv("MULTICALL_CHUNK_SIZE", "200"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+# 單次批次查詢 (含所有重試) 的時間上限
+FETCH_DEADLINE_SECONDS = float(os.getenv("FETCH_DEADLINE_SECONDS", "120"))
+RPC_RETRY_ATTEMPTS = int(os.getenv("RPC_RETRY_ATTEMPTS", "4"))
+RPC_RETRY_BASE_DELAY = float(os.getenv("RPC_RETRY_BASE_DELAY", "0.5"))
+RPC_RETRY_MAX_DELAY = float(os.getenv("RPC_RETRY_MAX_DELAY", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+# RPC 失敗時，最多沿用多久以前的 LTV (標記為 stale)
+STALE_MAX_AGE_SECONDS = int(os.getenv("STALE_MAX_AGE_SECONDS", "7200"))
+
+# Alerting
+# 同一個 Safe 持續超標時，兩次警報之間至少間隔多久
+ALERT_COOLDOWN_SECONDS = int(os.getenv("ALERT_COOLDOWN_SECONDS", "21600"))
+# LTV 需降到 (閾值 - hysteresis) 以下才算恢復，避免在閾值附近來回觸發
+ALERT_HYSTERESIS = float(os.getenv("ALERT_HYSTERESIS", "2.0"))
+# LTV 超過 (閾值 + escalation step) 時升級警報，無視 cooldown 立即通知
+ALERT_ESCALATION_STEP = float(os.getenv("ALERT_ESCALATION_STEP", "5.0"))
+
+# Scheduling
+# 每個 Safe 的檢查間隔；排程每個 tick 只掃描已到期的 Safe
+MONITOR_INTERVAL_SECONDS = int(os.getenv("MONITOR_INTERVAL_SECONDS", "3600"))
+MONITOR_TICK_SECONDS = int(os.getenv("MONITOR_TICK_SECONDS", "300"))
+# LTV 距閾值在此範圍內 (LTV %)、但趨勢點數還不夠的 Safe 每個 tick 檢查 (例如重啟後趨勢視窗只剩快照一個點)
+NEAR_THRESHOLD_MARGIN = float(os.getenv("NEAR_THRESHOLD_MARGIN", "5.0"))
+
+# /list
+# 快照超過這個時間才允許 /list refresh 即時查鏈
+LIST_REFRESH_MIN_AGE_SECONDS = int(os.getenv("LIST_REFRESH_MIN_AGE_SECONDS", "300"))
+
+# LTV lens
+# 以 eth_call state override 在節點端計算 LTV (回傳 uint16 basis points)，節點不支援時自動退回 Multicall
+LTV_LENS_ENABLED = os.getenv("LTV_LENS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Forecast
+# 每個 Safe 保留最近幾個 (block, LTV) 點做趨勢擬合，至少幾個點才估算斜率
+FORECAST_WINDOW = int(os.getenv("FORECAST_WINDOW", "8"))
+FORECAST_MIN_POINTS = int(os.getenv("FORECAST_MIN_POINTS", "3"))
+# 換算區塊數與秒數 (Scroll 約 3 秒一個區塊)
+BLOCK_TIME_SECONDS = float(os.getenv("BLOCK_TIME_SECONDS", "3"))
+# 依趨勢預估將在這段時間內超標時先發預警 (與 ALERT_COOLDOWN_SECONDS 共用冷卻)
+PREALERT_ENABLED = os.getenv("PREALERT_ENABLED", "false").lower() in ("1", "true", "yes")
+PREALERT_HORIZON_SECONDS = int(os.getenv("PREALERT_HORIZON_SECONDS", "7200"))
@@ -1,5 +1,7 @@
 from sqlalchemy.orm import Session
-from db.models import User, Monitor
+from sqlalchemy import func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from db.models import User, Monitor, MonitorChange, LtvSnapshot, MonitorPrealert, MonitorAlertState
 from datetime import datetime
 
 # --- User 操作 ---
@@ -43,6 +45,8 @@ def add_monitor(db: Session, telegram_id: str, address: str, name: str = "My Saf
         alert_threshold=80.0 # 預設 80%
     )
     db.add(new_monitor)
+    db.flush() # 先取得 new_monitor.id，和變更紀錄在同一個 transaction 提交
+    db.add(MonitorChange(monitor_id=new_monitor.id, op="upsert"))
     db.commit()
     db.refresh(new_monitor)
     return new_monitor, True # True 代表新增成功
@@ -66,6 +70,17 @@ def update_last_alert(db: Session, monitor_id: int):
         monitor.last_alert_at = datetime.utcnow()
         db.commit()
 
+def update_last_alerts(db: Session, monitor_ids, alerted_at: datetime):
+    """批次更新多個 monitor 的上次警報時間 (單一 UPDATE + 單次 commit)"""
+    ids = [int(mid) for mid in monitor_ids]
+    if not ids:
+        return 0
+    updated = db.query(Monitor).filter(Monitor.id.in_(ids)).update(
+        {Monitor.last_alert_at: alerted_at}, synchronize_session=False
+    )
+    db.commit()
+    return updated
+
 def delete_monitor(db: Session, telegram_id: str, address: str):
     """刪除監控"""
     user = get_user_by_tg_id(db, telegram_id)
@@ -78,7 +93,160 @@ def delete_monitor(db: Session, telegram_id: str, address: str):
     ).first()
     
     if monitor:
+        db.add(MonitorChange(monitor_id=monitor.id, op="delete"))
+        db.query(MonitorPrealert).filter(MonitorPrealert.monitor_id == monitor.id).delete(synchronize_session=False)
+        db.query(MonitorAlertState).filter(MonitorAlertState.monitor_id == monitor.id).delete(synchronize_session=False)
         db.delete(monitor)
         db.commit()
         return True
-    return False
\ No newline at end of file
+    return False
+
+# --- MonitorRegistry 同步用 ---
+
+def get_latest_change_seq(db: Session) -> int:
+    """目前最新的 change sequence (沒有任何紀錄時為 0)"""
+    return db.query(func.max(MonitorChange.id)).scalar() or 0
+
+def get_monitor_changes(db: Session, since_seq: int):
+    """取得 seq > since_seq 的變更紀錄，依 seq 排序"""
+    return db.query(MonitorChange.id, MonitorChange.monitor_id, MonitorChange.op).filter(
+        MonitorChange.id > since_seq
+    ).order_by(MonitorChange.id).all()
+
+def prune_monitor_changes(db: Session, up_to_seq: int) -> int:
+    """刪除 seq <= up_to_seq 的變更紀錄 (已被整表載入涵蓋)，回傳刪除筆數"""
+    if up_to_seq <= 0:
+        return 0
+    deleted = db.query(MonitorChange).filter(
+        MonitorChange.id <= up_to_seq
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def get_monitor_rows(db: Session, monitor_ids=None):
+    """
+    以純欄位查詢 (不建立 ORM 物件) 取得 active monitors，
+    回傳 (id, safe_address, alert_threshold, telegram_id, last_alert_at) tuples。
+    monitor_ids 為 None 時抓全部。
+    """
+    query = db.query(
+        Monitor.id,
+        Monitor.safe_address,
+        Monitor.alert_threshold,
+        User.telegram_id,
+        Monitor.last_alert_at,
+    ).join(User, Monitor.user_id == User.id).filter(Monitor.is_active == True)
+
+    if monitor_ids is not None:
+        query = query.filter(Monitor.id.in_(list(monitor_ids)))
+    return query.all()
+
+# --- LTV Snapshot 操作 ---
+
+# 每個 INSERT 的筆數上限 (Postgres 單一語句最多 65535 個參數)
+SNAPSHOT_UPSERT_BATCH = 1000
+
+def upsert_ltv_snapshots(db: Session, snapshots: list[dict]):
+    """
+    批次寫入最新 LTV。snapshots: [{safe_address, ltv, status, block_number, updated_at}, ...]
+
+    以 INSERT ... ON CONFLICT DO UPDATE 一次寫入；已存在且區塊較新的紀錄不會被舊資料覆蓋。
+    """
+    if not snapshots:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect not in ("postgresql", "sqlite"):
+        # 其他資料庫沒有 ON CONFLICT，逐筆 merge
+        for snapshot in snapshots:
+            db.merge(LtvSnapshot(**snapshot))
+        db.commit()
+        return
+
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    for i in range(0, len(snapshots), SNAPSHOT_UPSERT_BATCH):
+        stmt = insert(LtvSnapshot).values(snapshots[i:i + SNAPSHOT_UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[LtvSnapshot.safe_address],
+            set_={
+                "ltv": stmt.excluded.ltv,
+                "status": stmt.excluded.status,
+                "block_number": stmt.excluded.block_number,
+                "updated_at": stmt.excluded.updated_at,
+            },
+            where=or_(
+                LtvSnapshot.block_number.is_(None),
+                stmt.excluded.block_number.is_(None),
+                LtvSnapshot.block_number <= stmt.excluded.block_number,
+            ),
+        )
+        db.execute(stmt)
+    db.commit()
+
+def get_ltv_snapshots(db: Session, addresses=None) -> dict:
+    """addr (checksum) -> LtvSnapshot；addresses 為 None 時抓全部"""
+    query = db.query(LtvSnapshot)
+    if addresses is not None:
+        query = query.filter(LtvSnapshot.safe_address.in_(list(addresses)))
+    return {s.safe_address: s for s in query.all()}
+
+# --- 警報狀態 ---
+
+def save_alert_states(db: Session, monitor_ids, states, updated_at: datetime):
+    """批次寫入 (或更新) 多個 monitor 的警報狀態 (monitor_ids 與 states 對齊)"""
+    rows = [
+        {"monitor_id": int(mid), "state": int(state), "updated_at": updated_at}
+        for mid, state in zip(monitor_ids, states)
+    ]
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect not in ("postgresql", "sqlite"):
+        for row in rows:
+            db.merge(MonitorAlertState(**row))
+        db.commit()
+        return
+
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    for i in range(0, len(rows), SNAPSHOT_UPSERT_BATCH):
+        stmt = insert(MonitorAlertState).values(rows[i:i + SNAPSHOT_UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MonitorAlertState.monitor_id],
+            set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at},
+        )
+        db.execute(stmt)
+    db.commit()
+
+def get_alert_states(db: Session) -> dict:
+    """monitor_id -> 上次保存的警報狀態"""
+    return dict(db.query(MonitorAlertState.monitor_id, MonitorAlertState.state).all())
+
+# --- 趨勢預警 ---
+
+def record_prealerts(db: Session, monitor_ids, sent_at: datetime):
+    """批次寫入 (或更新) 多個 monitor 的上次預警時間"""
+    rows = [{"monitor_id": int(mid), "sent_at": sent_at} for mid in monitor_ids]
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect not in ("postgresql", "sqlite"):
+        for row in rows:
+            db.merge(MonitorPrealert(**row))
+        db.commit()
+        return
+
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    for i in range(0, len(rows), SNAPSHOT_UPSERT_BATCH):
+        stmt = insert(MonitorPrealert).values(rows[i:i + SNAPSHOT_UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MonitorPrealert.monitor_id],
+            set_={"sent_at": stmt.excluded.sent_at},
+        )
+        db.execute(stmt)
+    db.commit()
+
+def get_prealerts(db: Session) -> dict:
+    """monitor_id -> 上次預警時間"""
+    return dict(db.query(MonitorPrealert.monitor_id, MonitorPrealert.sent_at).all())
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, ForeignKey
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 
@@ -41,4 +41,74 @@ class Monitor(Base):
     owner = relationship("User", back_populates="monitors")
 
     def __repr__(self):
-        return f"<Monitor(addr={self.safe_address}, threshold={self.alert_threshold})>"
\ No newline at end of file
+        return f"<Monitor(addr={self.safe_address}, threshold={self.alert_threshold})>"
+
+class MonitorChange(Base):
+    """
+    Monitor 變更紀錄 (change log)。
+
+    add_monitor / delete_monitor 每次寫入一筆，id 即為遞增的 change sequence，
+    讓 MonitorRegistry 只需拉取 seq > 上次同步位置 的差量，而不必重載整張表。
+    """
+    __tablename__ = "monitor_changes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # 不設 ForeignKey：刪除後 tombstone 仍需保留
+    monitor_id = Column(Integer, nullable=False, index=True)
+    op = Column(String, nullable=False) # "upsert" 或 "delete"
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<MonitorChange(seq={self.id}, monitor_id={self.monitor_id}, op={self.op})>"
+
+class LtvSnapshot(Base):
+    """
+    每個 Safe 最新一次查到的 LTV。
+
+    Monitor loop 每輪批次 upsert，/list 直接讀這張表而不必打鏈；
+    重啟時 scheduler 也從這裡還原狀態，不需要冷啟動掃全部地址。
+    """
+    __tablename__ = "ltv_snapshots"
+
+    # Checksum 格式；多個用戶監控同一個 Safe 時共用一筆
+    safe_address = Column(String, primary_key=True)
+    ltv = Column(Float, nullable=False)
+    status = Column(String, nullable=False) # blockchain.ltv 的 STATUS_* (ok / retried / reverted)
+    block_number = Column(BigInteger, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<LtvSnapshot(addr={self.safe_address}, ltv={self.ltv}, block={self.block_number})>"
+
+class MonitorAlertState(Base):
+    """
+    每個 monitor 的警報狀態 (bot.alerts 的 STATE_*)，狀態改變時寫入。
+
+    重啟後用來還原 ESCALATED 等狀態；只靠 last_alert_at 會把已升級的 Safe 當成 COOLDOWN，
+    下一輪又升級、立即重發一次。獨立成一張表的理由同 MonitorPrealert。
+    """
+    __tablename__ = "monitor_alert_states"
+
+    # 不設 ForeignKey：delete_monitor 會一併刪除
+    monitor_id = Column(Integer, primary_key=True)
+    state = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<MonitorAlertState(monitor_id={self.monitor_id}, state={self.state})>"
+
+class MonitorPrealert(Base):
+    """
+    每個 monitor 上次發出趨勢預警 (early warning) 的時間。
+
+    預警有自己的 cooldown；存在 DB 才能在重啟後還原，不會重發 horizon 內的所有預警。
+    獨立成一張表 (而非 monitors 的欄位)，create_all 就能在既有資料庫上建立。
+    """
+    __tablename__ = "monitor_prealerts"
+
+    # 不設 ForeignKey：delete_monitor 會一併刪除
+    monitor_id = Column(Integer, primary_key=True)
+    sent_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<MonitorPrealert(monitor_id={self.monitor_id}, sent_at={self.sent_at})>"
@@ -0,0 +1,221 @@
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import config
+from db.crud import get_latest_change_seq, get_monitor_changes, get_monitor_rows, prune_monitor_changes
+
+# 20 bytes 的原始地址 (void dtype 不會像 'S20' 一樣吃掉結尾的 \x00)
+ADDRESS_DTYPE = np.dtype((np.void, 20))
+
+
+def pack_address(address: str) -> bytes:
+    """'0xAbC...' -> 20 bytes (大小寫不影響，checksum 與否皆可)"""
+    return bytes.fromhex(address[2:] if address[:2].lower() == "0x" else address)
+
+
+def to_epoch(dt) -> int:
+    """DB 裡的 naive UTC datetime -> epoch 秒數，None 代表從未警報 (0)"""
+    if dt is None:
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def from_epoch(ts: int) -> datetime:
+    """epoch 秒數 -> naive UTC datetime (與 update_last_alert 寫入的格式一致)"""
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc).replace(tzinfo=None)
+
+
+class MonitorRegistry:
+    """
+    常駐記憶體的 Monitor 表 (column-oriented)。
+
+    每個 active monitor 佔一個 row，欄位以 numpy array 存放：
+    - monitor_ids   int64
+    - addresses     bytes20 (packed)
+    - thresholds    float32
+    - chat_ids      int64
+    - last_alert_at int64 (epoch 秒，0 = 從未警報)
+
+    第一次 sync() 時整表載入，之後只依 monitor_changes 的 seq 拉差量
+    (每次往回重讀 REGISTRY_SYNC_LOOKBACK 個 seq，補上較晚 commit 的變更)，
+    讓 monitor loop 不需每輪重建 ORM 物件，閾值比較也變成一次向量運算。
+    其他模組可以用 register_column() 掛上自己的 per-monitor 狀態，
+    新增/刪除 row 時會一起搬移。
+    """
+
+    def __init__(self):
+        self._specs = {}
+        self._columns = {}
+        self._index = {}  # monitor_id -> row
+        self.synced_seq = 0
+        self.loaded_at = 0.0
+        self._applied = set()  # lookback 視窗內已套用過的 change seq
+
+        self.register_column("monitor_ids", np.int64, 0)
+        self.register_column("addresses", ADDRESS_DTYPE, bytes(20))
+        self.register_column("thresholds", np.float32, 0.0)
+        self.register_column("chat_ids", np.int64, 0)
+        self.register_column("last_alert_at", np.int64, 0)
+
+    # --- 欄位管理 ---
+
+    def register_column(self, name: str, dtype, fill, shape: tuple = ()):
+        """新增一個 per-monitor 欄位；已存在的 row 以 fill 初始化"""
+        if name in self._specs:
+            return
+        self._specs[name] = (np.dtype(dtype), fill, tuple(shape))
+        self._columns[name] = self._blank(name, len(self))
+
+    def _blank(self, name: str, n: int) -> np.ndarray:
+        dtype, fill, shape = self._specs[name]
+        if dtype == ADDRESS_DTYPE:
+            return np.zeros((n,) + shape, dtype=dtype)
+        return np.full((n,) + shape, fill, dtype=dtype)
+
+    def column(self, name: str) -> np.ndarray:
+        return self._columns[name]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def monitor_ids(self) -> np.ndarray:
+        return self._columns["monitor_ids"]
+
+    @property
+    def addresses(self) -> np.ndarray:
+        return self._columns["addresses"]
+
+    @property
+    def thresholds(self) -> np.ndarray:
+        return self._columns["thresholds"]
+
+    @property
+    def chat_ids(self) -> np.ndarray:
+        return self._columns["chat_ids"]
+
+    @property
+    def last_alert_at(self) -> np.ndarray:
+        return self._columns["last_alert_at"]
+
+    def row_of(self, monitor_id: int):
+        return self._index.get(int(monitor_id))
+
+    # --- 與 DB 同步 ---
+
+    def sync(self, db: Session, full: bool = False) -> tuple[int, int]:
+        """
+        與 DB 同步，回傳 (新增/更新數, 移除數)。
+
+        full=True 或尚未載入過時整表重載；否則套用 lookback 視窗內尚未套用過的變更。
+        seq 由 DB 在 INSERT 時配發、但依 commit 順序才可見，
+        所以 seq 比 synced_seq 小的變更仍可能在之後才出現。
+        """
+        if full or not self.loaded_at:
+            return self._load_full(db)
+
+        since = max(0, self.synced_seq - config.REGISTRY_SYNC_LOOKBACK)
+        changes = [c for c in get_monitor_changes(db, since) if c[0] not in self._applied]
+        if not changes:
+            return 0, 0
+
+        touched = {monitor_id for _, monitor_id, _ in changes}
+        rows = get_monitor_rows(db, touched)
+
+        # 查得到的是 upsert，查不到的 (已刪除或被停用) 就從 registry 移除
+        present = {row[0] for row in rows}
+        removed = self._remove([mid for mid in touched if mid not in present])
+        self._upsert(rows)
+
+        self.synced_seq = max(self.synced_seq, changes[-1][0])
+        floor = self.synced_seq - config.REGISTRY_SYNC_LOOKBACK
+        self._applied = {seq for seq in self._applied if seq > floor}
+        self._applied.update(seq for seq, _, _ in changes if seq > floor)
+        return len(rows), removed
+
+    def _load_full(self, db: Session) -> tuple[int, int]:
+        # 先記 seq 與視窗內已可見的變更再讀資料：期間的變更下次 sync 會再套用一次 (upsert 是冪等的)
+        seq = get_latest_change_seq(db)
+        floor = seq - config.REGISTRY_SYNC_LOOKBACK
+        applied = {change[0] for change in get_monitor_changes(db, max(0, floor))}
+        rows = get_monitor_rows(db)
+
+        # 以差異套用而非清空重建，仍存在的 monitor 保留其他模組掛上的欄位 (警報狀態等)
+        present = {row[0] for row in rows}
+        removed = self._remove([mid for mid in self._index if mid not in present])
+        self._upsert(rows)
+
+        self.synced_seq = seq
+        self._applied = applied
+        self.loaded_at = time.time()
+
+        # 整表載入已涵蓋視窗以下的變更，change log 不需無限成長
+        prune_monitor_changes(db, floor)
+        return len(rows), removed
+
+    def _upsert(self, rows):
+        new_rows = []
+        for row in rows:
+            existing = self._index.get(row[0])
+            if existing is None:
+                new_rows.append(row)
+            else:
+                self._write_row(existing, row)
+
+        if not new_rows:
+            return
+
+        start = len(self)
+        for name in self._specs:
+            self._columns[name] = np.concatenate(
+                [self._columns[name], self._blank(name, len(new_rows))]
+            )
+        for offset, row in enumerate(new_rows):
+            self._index[row[0]] = start + offset
+            self._write_row(start + offset, row)
+
+    def _write_row(self, i: int, row):
+        monitor_id, safe_address, alert_threshold, telegram_id, last_alert_at = row
+        self._columns["monitor_ids"][i] = monitor_id
+        self._columns["addresses"][i] = np.void(pack_address(safe_address))
+        self._columns["thresholds"][i] = alert_threshold
+        self._columns["chat_ids"][i] = int(telegram_id)
+        self._columns["last_alert_at"][i] = to_epoch(last_alert_at)
+
+    def _remove(self, monitor_ids) -> int:
+        rows = [self._index[mid] for mid in monitor_ids if mid in self._index]
+        if not rows:
+            return 0
+
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows] = False
+        for name in self._specs:
+            self._columns[name] = self._columns[name][keep]
+
+        self._index = {int(mid): i for i, mid in enumerate(self._columns["monitor_ids"])}
+        return len(rows)
+
+    # --- 查詢 ---
+
+    def unique_addresses(self, rows: np.ndarray = None) -> tuple[list[str], np.ndarray]:
+        """
+        去重後的地址 (小寫 0x hex) 與 inverse index。
+
+        同一個 Safe 被多個用戶監控時只需查一次鏈，
+        之後用 values[inverse] 就能攤回每個 row。
+        """
+        addresses = self.addresses if rows is None else self.addresses[rows]
+        unique, inverse = np.unique(addresses, return_inverse=True)
+        return ["0x" + bytes(a).hex() for a in unique], inverse.reshape(-1)
+
+    def breaching(self, ltv: np.ndarray) -> np.ndarray:
+        """ltv 與 row 對齊；回傳超過各自閾值的 bool mask (查詢失敗的 -1.0 永遠不會觸發)"""
+        return ltv > self.thresholds
+
+    def mark_alerted(self, rows: np.ndarray, ts: int):
+        self._columns["last_alert_at"][rows] = ts
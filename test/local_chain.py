@@ -0,0 +1,29 @@
+"""
+測試共用：把 blockchain.client 的 w3 換成本地 EVM (eth-tester + py-evm)，不連外部 RPC。
+
+需要：pip install "eth-tester[py-evm]"
+必須在 import blockchain.fetcher (以及會間接 import 它的 bot.*) 之前呼叫。
+"""
+import sys
+import types
+
+from web3 import Web3, EthereumTesterProvider
+
+import config
+
+# 沒有設定合約地址時使用的佔位地址 (本地 EVM 上沒有程式碼)
+PLACEHOLDER_DEBT_MANAGER = Web3.to_checksum_address("0x" + "11" * 20)
+PLACEHOLDER_DATA_PROVIDER = Web3.to_checksum_address("0x" + "22" * 20)
+
+def use_local_chain(w3: Web3 = None, debt_manager: str = None) -> Web3:
+    """
+    以 w3 (預設新建一條 eth-tester 鏈) 取代 blockchain.client，並補上合約地址設定。
+    debt_manager 有給時覆蓋 config.DEBT_MANAGER_ADDR (例如指向已部署的 mock)。
+    """
+    w3 = w3 or Web3(EthereumTesterProvider())
+    client = types.ModuleType("blockchain.client")
+    client.w3 = w3
+    sys.modules["blockchain.client"] = client
+    config.DEBT_MANAGER_ADDR = debt_manager or config.DEBT_MANAGER_ADDR or PLACEHOLDER_DEBT_MANAGER
+    config.ETHERFI_DATA_PROVIDER_ADDR = config.ETHERFI_DATA_PROVIDER_ADDR or PLACEHOLDER_DATA_PROVIDER
+    return w3
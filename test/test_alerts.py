@@ -0,0 +1,132 @@
+"""
+警報狀態機、digest 分組，以及重啟後的狀態還原 (建議用 SQLite：DATABASE_URL=sqlite:///./test.db)。
+"""
+import numpy as np
+
+from bot.alerts import (
+    STATE_OK, STATE_ALERTING, STATE_COOLDOWN, STATE_ESCALATED, STATE_NAMES,
+    register_alert_columns, warm_alert_state, evaluate_alerts, group_by_chat, split_digest, format_digest,
+    MESSAGE_LIMIT,
+)
+from db import init_db, SessionLocal, crud
+from db.registry import MonitorRegistry, from_epoch
+
+COOLDOWN = 3600
+HYSTERESIS = 2.0
+ESCALATION_STEP = 5.0
+
+def step(state, ltv, last_alert_at, now, valid=None):
+    ltv = np.asarray(ltv, dtype=np.float32)
+    thresholds = np.full(len(ltv), 80.0, dtype=np.float32)
+    valid = np.ones(len(ltv), dtype=bool) if valid is None else np.asarray(valid)
+    return evaluate_alerts(state, ltv, thresholds, last_alert_at, valid, now,
+                           COOLDOWN, HYSTERESIS, ESCALATION_STEP)
+
+def restart(now, saved):
+    """模擬重啟：新的 registry 從 DB 欄位載入 last_alert_at，再還原警報狀態"""
+    registry = MonitorRegistry()
+    register_alert_columns(registry)
+    registry._upsert([(1, "0x" + "ab" * 20, 80.0, "777002", from_epoch(now - 600))])
+    warm_alert_state(registry, now, COOLDOWN, saved)
+    return registry
+
+def check_restart(now):
+    print("\n--- Restart ---")
+    # 10 分鐘前才升級過的 Safe，LTV 仍在 90%
+    ltv = [90.0]
+
+    # 沒有保存狀態時只能從 last_alert_at 推回 COOLDOWN，下一輪會重新升級並立即重發
+    registry = restart(now, {})
+    state, send = step(registry.column("alert_state").copy(), ltv, registry.last_alert_at, now)
+    assert state[0] == STATE_ESCALATED and send[0]
+
+    # 保存的狀態寫入 DB 後再還原：維持 ESCALATED，cooldown 內不重發
+    init_db()
+    db = SessionLocal()
+    try:
+        crud.save_alert_states(db, [1], [STATE_ALERTING], from_epoch(now - 1200))
+        crud.save_alert_states(db, [1], [STATE_ESCALATED], from_epoch(now - 600))  # 同一個 monitor -> 更新
+        saved = crud.get_alert_states(db)
+    finally:
+        db.close()
+    assert saved[1] == STATE_ESCALATED
+
+    registry = restart(now, saved)
+    state, send = step(registry.column("alert_state").copy(), ltv, registry.last_alert_at, now)
+    print(f"LTV 90% after restart -> {STATE_NAMES[int(state[0])]} (send={bool(send[0])})")
+    assert state[0] == STATE_ESCALATED and not send[0]
+
+    # cooldown 過後才再提醒
+    state, send = step(state, ltv, registry.last_alert_at, now + COOLDOWN)
+    assert state[0] == STATE_ESCALATED and send[0]
+
+def main():
+    # 單一 Safe 的 LTV 走勢 (每輪間隔 10 分鐘)
+    series = [70, 81, 82, 79, 81, 86, 87, 82, 77, 81]
+    expected = [
+        (STATE_OK, False),         # 70: 未超標
+        (STATE_ALERTING, True),    # 81: 首次超標 -> 發送
+        (STATE_COOLDOWN, False),   # 82: cooldown 中
+        (STATE_COOLDOWN, False),   # 79: 在 hysteresis 區間 (78~80)，不算恢復
+        (STATE_COOLDOWN, False),   # 81: 再次超標但仍在 cooldown，不重發
+        (STATE_ESCALATED, True),   # 86: 超過升級線 85 -> 立即發送
+        (STATE_ESCALATED, False),  # 87: 已升級，cooldown 中
+        (STATE_COOLDOWN, False),   # 82: 降到升級線 - hysteresis 以下 -> 降級，不發送
+        (STATE_OK, False),         # 77: 低於 78 -> 恢復
+        (STATE_ALERTING, True),    # 81: 恢復後再次超標 -> 發送
+    ]
+
+    state = np.array([STATE_OK], dtype=np.int8)
+    last_alert_at = np.array([0], dtype=np.int64)
+    now = 1_000_000
+
+    print("--- State machine walk ---")
+    for ltv, (want_state, want_send) in zip(series, expected):
+        state, send = step(state, [ltv], last_alert_at, now)
+        print(f"LTV {ltv}% -> {STATE_NAMES[int(state[0])]} (send={bool(send[0])})")
+        assert state[0] == want_state and send[0] == want_send
+        last_alert_at[send] = now
+        now += 600
+
+    # cooldown 過後持續超標會再提醒一次
+    state = np.array([STATE_COOLDOWN], dtype=np.int8)
+    state, send = step(state, [82], np.array([now - COOLDOWN]), now)
+    assert state[0] == STATE_ALERTING and send[0]
+
+    # 本輪沒有新資料 (stale / RPC 失敗) 時狀態不變
+    state = np.array([STATE_ESCALATED], dtype=np.int8)
+    state, send = step(state, [-1.0], np.array([0]), now, valid=[False])
+    assert state[0] == STATE_ESCALATED and not send[0]
+
+    print("\n--- Digest grouping ---")
+    chat_ids = np.array([111, 222, 111, 333, 222], dtype=np.int64)
+    groups = group_by_chat(chat_ids, np.array([0, 1, 2, 4]))
+    print([(chat, rows.tolist()) for chat, rows in groups])
+    assert [(chat, list(rows)) for chat, rows in groups] == [(111, [0, 2]), (222, [1, 4])]
+
+    message = format_digest([
+        ("0x7Ca0b75E67E33c0014325B739A8d019C4FE445F0", 86.5, 80.0, STATE_ESCALATED),
+        ("0x000000000000000000000000000000000000dEaD", 81.2, 80.0, STATE_ALERTING),
+    ])
+    print(message)
+    assert message.count("\n[") == 2
+    assert split_digest([("0x" + "ab" * 20, 81.0, 80.0, STATE_ALERTING)]) == [([("0x" + "ab" * 20, 81.0, 80.0, STATE_ALERTING)], [])]
+
+    print("\n--- Digest over the Telegram limit ---")
+    # 單一 chat 有 300 個超標 + 60 個預警的 Safe，一則訊息放不下
+    entries = [(f"0x{i:040x}", 85.0 + i % 10, 80.0, STATE_ESCALATED if i % 3 else STATE_ALERTING) for i in range(300)]
+    early = [(f"0x{i:040x}", 75.0, 80.0, 3600.0 + i) for i in range(60)]
+    assert len(format_digest(entries, early)) > MESSAGE_LIMIT
+
+    parts = split_digest(entries, early)
+    messages = [format_digest(a, e, part=(i, len(parts))) for i, (a, e) in enumerate(parts, 1)]
+    print(f"{len(parts)} messages, longest {max(map(len, messages))} chars")
+    assert len(parts) > 1 and all(len(m) <= MESSAGE_LIMIT for m in messages)
+    assert messages[0].splitlines()[0].endswith(f"(1/{len(parts)})")
+    # 依原順序完整切分，沒有遺漏或重複
+    assert [x for a, _ in parts for x in a] == entries and [x for _, e in parts for x in e] == early
+
+    check_restart(now)
+
+if __name__ == "__main__":
+    main()
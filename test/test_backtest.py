@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import config
+from backtest.replay import replay, format_report, analyze, _source_tag
+
+SAFE_A = "0x7ca0b75e67e33c0014325b739a8d019c4fe445f0"
+SAFE_B = "0x000000000000000000000000000000000000dead"
+
+def build_archive(path: str):
+    """
+    罐頭狀態：
+    - SAFE_A 的 LTV 從 50% 一路爬升到 95%，在 block 1095 被清算
+    - SAFE_B 在 82% 附近來回震盪 (只會製造噪音)，從未被清算
+    """
+    collateral = 10_000 * 10**6
+    states_a = [[1000 + i * 10, collateral, collateral * (50 + i * 5) // 100] for i in range(10)]
+    states_b = [[1000 + i * 10, collateral, collateral * (78 if i % 2 else 82) // 100] for i in range(10)]
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "states": {SAFE_A: states_a, SAFE_B: states_b},
+            "liquidations": [{"safe": SAFE_A, "block": 1095}],
+        }, f)
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = os.path.join(tmp, "canned.json")
+        cache_dir = os.path.join(tmp, "cache")
+        build_archive(archive_path)
+        spec = {"kind": "archive", "path": archive_path}
+
+        print("--- Replaying canned archive (2 workers) ---")
+        start_time = time.time()
+        report = replay(spec, [SAFE_A, SAFE_B], 1000, 1095, step=5,
+                        thresholds=[80.0, 90.0], workers=2, cache_dir=cache_dir)
+        print(f"Took {time.time() - start_time:.4f}s")
+        print(format_report(report, block_time=3.0))
+
+        # 80%: SAFE_A 在 block 1070 (LTV 80% -> 85%) 觸發，比清算早 25 個區塊
+        s80 = report[80.0]["summary"]
+        assert s80["caught"] == 1 and s80["missed"] == 0
+        assert report[80.0]["safes"][SAFE_A]["liquidations"][0]["lead_blocks"] == 25
+        # SAFE_B 每次回到 82% 都會重新觸發
+        assert s80["false_alarms"] == len(report[80.0]["safes"][SAFE_B]["fires"]) > 0
+
+        # 90%: 較晚觸發，lead time 較短，但沒有噪音
+        s90 = report[90.0]["summary"]
+        assert report[90.0]["safes"][SAFE_A]["liquidations"][0]["lead_blocks"] == 5
+        assert s90["false_alarms"] == 0
+
+        # 第二次重跑應完全命中磁碟快取，結果一致
+        print("\n--- Replaying again from cache (in-process) ---")
+        cached = replay(spec, [SAFE_A, SAFE_B], 1000, 1095, step=5,
+                        thresholds=[80.0, 90.0], workers=1, cache_dir=cache_dir)
+        assert cached == report
+        print("Cached replay matches.")
+
+    # 查詢失敗 (NaN) 不應切斷持續超標的區間：只算一次觸發
+    print("\n--- Missing samples ---")
+    blocks = np.array([1000, 1010, 1020, 1030, 1040], dtype=np.int64)
+    ltv = np.array([[np.nan, 85.0, np.nan, 86.0, np.nan], [70.0, np.nan, 85.0, np.nan, 75.0]], dtype=np.float32)
+    gaps = analyze([SAFE_A, SAFE_B], blocks, ltv, [80.0], [])[80.0]
+    print({addr: safe["fires"] for addr, safe in gaps["safes"].items()})
+    assert gaps["safes"][SAFE_A]["fires"] == [1010]
+    assert gaps["safes"][SAFE_B]["fires"] == [1020]
+
+    # RPC 快取依節點與合約區分
+    rpc_url, debt_manager = config.SCROLL_RPC_URL, config.DEBT_MANAGER_ADDR
+    try:
+        config.SCROLL_RPC_URL, config.DEBT_MANAGER_ADDR = "https://rpc-a", "0x" + "1" * 40
+        tag_a = _source_tag({"kind": "rpc"})
+        config.SCROLL_RPC_URL = "https://rpc-b"
+        tag_b = _source_tag({"kind": "rpc"})
+        config.DEBT_MANAGER_ADDR = "0x" + "2" * 40
+        tag_c = _source_tag({"kind": "rpc"})
+    finally:
+        config.SCROLL_RPC_URL, config.DEBT_MANAGER_ADDR = rpc_url, debt_manager
+    assert len({tag_a, tag_b, tag_c}) == 3
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+趨勢預測測試：累計量擬合 (與 np.polyfit 比對)、超標時間、排程、100k monitors 的每輪成本，
+以及預警時間寫入 DB 後在重啟時還原 (建議用 SQLite：DATABASE_URL=sqlite:///./test.db)。
+"""
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from bot.alerts import format_digest
+from bot.forecast import (
+    register_forecast_columns, warm_prealerts, record_points, fit_trend, time_to_threshold, schedule_next_check
+)
+from db import init_db, SessionLocal, crud
+from db.registry import MonitorRegistry, to_epoch
+
+WINDOW = 8
+BLOCK_TIME = 3.0
+# 100k monitors 全部到期時每輪 record + fit + eta + schedule 的上限
+# 實測約 4~5 ms 寫入視窗 (ring buffer 的讀寫佔一半) + 1.5~2 ms 擬合排程，合計約 6~7 ms；
+# 一般每輪只有到期的 monitor 寫入新點，成本隨到期數量下降
+BUDGET_MS = 10.0
+
+def make_registry(count: int) -> MonitorRegistry:
+    registry = MonitorRegistry()
+    register_forecast_columns(registry, WINDOW)
+    registry._upsert([
+        (i + 1, f"0x{i + 1:040x}", 80.0, 1000 + i % 7, None) for i in range(count)
+    ])
+    return registry
+
+def polyfit_slope(registry, row):
+    """直接對 ring buffer 內的點做 np.polyfit，當作累計量的對照"""
+    count = int(registry.column("trend_n")[row])
+    x = registry.column("block_window")[row, :count].astype(np.float64)
+    y = registry.column("ltv_window")[row, :count]
+    return np.polyfit(x - x.max(), y, 1)[0]
+
+def check_prealert_persistence():
+    print("\n--- Pre-alert persistence ---")
+    init_db()
+    db = SessionLocal()
+    tg_id, address = "777001", "0x000000000000000000000000000000000000bEEF"
+    try:
+        crud.delete_monitor(db, tg_id, address)
+        monitor, _ = crud.add_monitor(db, tg_id, address, "Forecast Vault")
+        sent_at = datetime.utcnow().replace(microsecond=0)
+        crud.record_prealerts(db, [monitor.id], sent_at - timedelta(hours=1))
+        crud.record_prealerts(db, [monitor.id], sent_at)  # 同一個 monitor 再次預警 -> 更新
+        assert crud.get_prealerts(db)[monitor.id] == sent_at
+
+        # 重啟：新的 registry 從 DB 還原 last_prealert_at
+        registry = MonitorRegistry()
+        register_forecast_columns(registry, WINDOW)
+        registry.sync(db, full=True)
+        warm_prealerts(registry, crud.get_prealerts(db))
+        row = registry.row_of(monitor.id)
+        print(f"last_prealert_at after restart: {registry.column('last_prealert_at')[row]}")
+        assert registry.column("last_prealert_at")[row] == to_epoch(sent_at)
+
+        crud.delete_monitor(db, tg_id, address)
+        assert monitor.id not in crud.get_prealerts(db)
+    finally:
+        db.close()
+
+def main():
+    registry = make_registry(4)
+    rows = np.arange(4)
+
+    # row 0: 每 100 blocks +1%；row 1: 持平；row 2: 下降；row 3: 最後兩輪沒有新點
+    block = 1_000_000
+    for step in range(10):  # 超過 window，ring buffer 會覆蓋最舊的點
+        ltv = np.array([60 + step, 70, 75 - step, 50 + step], dtype=np.float64)
+        active = rows if step < 8 else rows[:3]
+        record_points(registry, active, block, ltv[active])
+        block += 100
+
+    print("--- Trend fit ---")
+    slope = fit_trend(registry, 3)
+    print(f"slope (LTV % / block): {slope.tolist()}")
+    assert abs(slope[0] - 0.01) < 1e-9 and abs(slope[1]) < 1e-12 and slope[2] < 0
+    assert abs(slope[3] - 0.01) < 1e-9
+    assert np.allclose(slope, [polyfit_slope(registry, row) for row in rows])
+    assert fit_trend(registry, WINDOW + 1).tolist() == [0.0] * 4
+
+    # 不規則的區塊間隔與雜訊：累計量在多次覆蓋 ring buffer 後仍與 polyfit 一致
+    noisy = make_registry(3)
+    rng = np.random.default_rng(1)
+    block = 5_000_000
+    for _ in range(5 * WINDOW):
+        block += int(rng.integers(1, 2000))
+        active = np.flatnonzero(rng.random(3) < 0.7)
+        record_points(noisy, active, block, rng.uniform(40, 90, len(active)))
+    expected = [polyfit_slope(noisy, row) if noisy.column("trend_n")[row] >= 3 else 0.0 for row in range(3)]
+    assert np.allclose(fit_trend(noisy, 3), expected, rtol=1e-6, atol=1e-12)
+
+    # 69% 往 80% 每 block +0.01% -> 1100 blocks -> 3300 秒
+    ltv = np.array([69.0, 70.0, 66.0, 81.0])
+    eta = time_to_threshold(ltv, registry.thresholds, slope, BLOCK_TIME)
+    print(f"eta (s): {eta.tolist()}")
+    assert abs(eta[0] - 3300) < 1e-6 and np.isinf(eta[1]) and np.isinf(eta[2]) and eta[3] == 0
+    assert np.isinf(time_to_threshold(np.array([-1.0]), np.array([80.0]), np.array([0.5]), BLOCK_TIME))[0]
+
+    next_check = schedule_next_check(eta, 0, 300, 3600)
+    print(f"next check in (s): {next_check.tolist()}")
+    assert next_check.tolist() == [1650, 3600, 3600, 300]
+
+    message = format_digest([], [("0x000000000000000000000000000000000000dEaD", 69.0, 80.0, float(eta[0]))])
+    print(message)
+    assert message.startswith("⏳") and "[EARLY]" in message and "~55m" in message
+
+    # 刪除 monitor 後視窗跟著 row 移動
+    registry._remove([1])
+    assert abs(fit_trend(registry, 3)[2] - 0.01) < 1e-9
+
+    print("\n--- 100k monitors ---")
+    count = 100_000
+    registry = make_registry(count)
+    rng = np.random.default_rng(0)
+    base = rng.uniform(40, 75, count)
+    trend = rng.normal(0, 0.005, count)
+    all_rows = np.arange(count)
+    for step in range(WINDOW):
+        record_points(registry, all_rows, 1_000_000 + step * 1200, base + trend * step * 1200)
+
+    # 每輪：所有 row 寫入新點 (ring buffer 已滿，會扣掉最舊的點) + 擬合 + 推估 + 排程
+    record_ms, cycle_ms = [], []
+    for step in range(WINDOW, WINDOW + 20):
+        ltv = base + trend * step * 1200
+        start = time.perf_counter()
+        record_points(registry, all_rows, 1_000_000 + step * 1200, ltv)
+        recorded = time.perf_counter()
+        slope = fit_trend(registry, 3)
+        eta = time_to_threshold(ltv, registry.thresholds, slope, BLOCK_TIME)
+        schedule_next_check(eta, 0, 300, 3600)
+        record_ms.append((recorded - start) * 1000)
+        cycle_ms.append((time.perf_counter() - start) * 1000)
+    best = min(cycle_ms)
+    print(f"record {min(record_ms):.2f} ms, full cycle best {best:.2f} ms (budget {BUDGET_MS} ms)")
+    assert np.allclose(slope, trend)
+    assert best < BUDGET_MS
+
+    check_prealert_persistence()
+
+if __name__ == "__main__":
+    main()
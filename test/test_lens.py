@@ -0,0 +1,216 @@
+"""
+在本地 EVM (eth-tester + py-evm) 上驗證 LTV lens 的 bytecode。
+
+需要：pip install "eth-tester[py-evm]"
+eth-tester 不支援 eth_call 的 state override，所以 lens 會直接部署成合約來測試邏輯；
+override 路徑則用來確認「節點不支援時會拋出例外」(Fetcher 依此退回 Multicall)。
+Fetcher 的部分把 call_lens 換成呼叫已部署的 lens、Multicall 換成逐一直接呼叫 mock。
+"""
+import time
+
+from eth_abi import encode
+from web3 import Web3, EthereumTesterProvider
+from web3.exceptions import Web3RPCError
+
+import config
+from local_chain import use_local_chain
+from blockchain.lens import (
+    LENS_RUNTIME_CODE, LENS_SATURATED, LensUnsupported, GET_USER_CURRENT_STATE_SELECTOR,
+    assemble, deploy_code, encode_lens_calldata, decode_lens_result, call_lens,
+)
+from blockchain.ltv import (
+    USER_STATE_OUTPUT_TYPES, STATUS_OK, STATUS_RETRIED, STATUS_REVERTED, STATUS_FAILED, compute_ltv, decode_user_state_ltv,
+)
+
+def mock_debt_manager(wrapped: bool = False) -> bytes:
+    """
+    假的 DebtManager：getUserCurrentState(safe) 從地址本身推出資產/負債
+      debt = (safe >> 8) & 0xffff, collateral = (safe >> 24) & 0xffff
+      safe 最低 byte 為 0xff 時 revert
+    預設回傳 ABI 的 4 個 flat 回傳值；wrapped=True 時改成包成單一 tuple 的編碼 (多一個開頭的 0x20 offset)，
+    用來確認 Fetcher 會發現 lens 與 Multicall 的結果不一致。
+    """
+    base = 0x20 if wrapped else 0
+    return assemble([
+        ("PUSH", 1, 4), "CALLDATALOAD",
+        "DUP1", ("PUSH", 1, 0xFF), "AND", ("PUSH", 1, 0xFF), "EQ", ("PUSH_LABEL", "revert"), "JUMPI",
+        "DUP1", ("PUSH", 1, 8), "SHR", ("PUSH", 2, 0xFFFF), "AND", ("PUSH", 1, base + 0x60), "MSTORE",
+        ("PUSH", 1, 24), "SHR", ("PUSH", 2, 0xFFFF), "AND", ("PUSH", 1, base + 0x20), "MSTORE",
+        # 兩個空的動態陣列 (offset 相對於 head 起點)
+        ("PUSH", 1, 0x80), ("PUSH", 1, base), "MSTORE",
+        ("PUSH", 1, 0xA0), ("PUSH", 1, base + 0x40), "MSTORE",
+    ] + ([("PUSH", 1, 0x20), ("PUSH", 1, 0), "MSTORE"] if wrapped else []) + [  # tuple 的 offset
+        ("PUSH", 1, 0xC0 + base), ("PUSH", 1, 0), "RETURN",
+        ("LABEL", "revert"), "JUMPDEST", ("PUSH", 1, 0), ("PUSH", 1, 0), "REVERT",
+    ])
+
+MOCK_DEBT_MANAGER = mock_debt_manager()
+
+def make_safe(collateral: int, debt: int, revert: bool = False) -> str:
+    return Web3.to_checksum_address(f"0x{'00' * 15}{collateral:04x}{debt:04x}{'ff' if revert else '01'}")
+
+def deploy(w3, runtime: bytes) -> str:
+    tx_hash = w3.eth.send_transaction({"from": w3.eth.accounts[0], "data": deploy_code(runtime)})
+    return w3.eth.get_transaction_receipt(tx_hash)["contractAddress"]
+
+def call_debt_manager(w3, debt_manager: str, safe: str, block_identifier="latest") -> bytes:
+    data = GET_USER_CURRENT_STATE_SELECTOR + bytes.fromhex(safe[2:]).rjust(32, b"\x00")
+    return bytes(w3.eth.call({"to": debt_manager, "data": data}, block_identifier))
+
+CASES = [
+    (10000, 5000, False),   # 50%
+    (30000, 24123, False),  # 80.41%
+    (0, 100, False),        # 分母為 0 -> 0%
+    (1, 65535, False),      # 超過 uint16 -> 飽和
+    (10000, 9000, True),    # revert -> 失敗旗標
+] + [(20000 + i, 15000 + i, False) for i in range(195)]
+
+def check_lens(w3, debt_manager, lens):
+    safes = [make_safe(*case) for case in CASES]
+
+    print(f"--- Lens over {len(safes)} safes ---")
+    start_time = time.time()
+    raw = bytes(w3.eth.call({"to": lens, "data": encode_lens_calldata(debt_manager, safes)}))
+    ltv, ok = decode_lens_result(raw, len(safes))
+    print(f"Took {time.time() - start_time:.4f}s, response {len(raw)} bytes")
+
+    for (collateral, debt, revert), value, success in zip(CASES, ltv, ok):
+        if revert:
+            assert not success
+        elif collateral and debt * 10000 // collateral >= LENS_SATURATED:
+            assert success and abs(value - LENS_SATURATED / 100) < 1e-3
+        else:
+            assert success and abs(value - compute_ltv(collateral, debt)) <= 0.01 + 1e-4
+    print(f"First values: {ltv[:5].tolist()} ok={ok[:5].tolist()}")
+
+    # 兩種解碼方式讀同一個 mock 必須一致：Multicall 路徑 (decode_user_state_ltv) 與 lens
+    for (collateral, debt, revert), safe, value in zip(CASES, safes, ltv):
+        if revert or (collateral and debt * 10000 // collateral >= LENS_SATURATED):
+            continue
+        decoded = decode_user_state_ltv(call_debt_manager(w3, debt_manager, safe))
+        assert decoded == compute_ltv(collateral, debt) and abs(decoded - value) <= 0.01 + 1e-4
+    print("decode_user_state_ltv agrees with the lens on every safe")
+
+    # 與 Multicall 原本要傳回的大小比較 (每個 Safe 各持有 2 種抵押品、1 種借款)
+    tokens = [("0x" + "11" * 20, 10**18), ("0x" + "22" * 20, 10**18)]
+    per_safe = len(encode(USER_STATE_OUTPUT_TYPES, [tokens, 1, tokens[:1], 1]))
+    multicall_size = len(safes) * (per_safe + 96)  # + Result tuple 的 success / offset / length
+    print(f"Multicall payload ~{multicall_size} bytes vs lens {len(raw)} bytes ({multicall_size / len(raw):.0f}x)")
+    assert multicall_size / len(raw) > 10
+
+    # eth-tester 不支援 state override：應拋出 LensUnsupported，讓 Fetcher 退回 Multicall
+    print("\n--- State override on eth-tester ---")
+    try:
+        call_lens(w3, debt_manager, safes[:1])
+        raise AssertionError("expected LensUnsupported")
+    except LensUnsupported as e:
+        print(f"Not supported ({type(e.__cause__).__name__}), Fetcher would fall back to Multicall.")
+
+def check_fetcher(w3, debt_manager, wrapped_debt_manager, lens):
+    print("\n--- Fetcher lens / Multicall paths ---")
+    use_local_chain(w3, debt_manager)
+    config.LTV_LENS_ENABLED = True
+
+    import blockchain.fetcher as fetcher_module
+    from blockchain.fetcher import DataFetcher
+
+    lens_errors = []
+    flag_tail = [0]
+
+    class OverrideNode:
+        """支援 state override 的節點：override 的 code 交給部署好的 lens 執行；可注入 RPC 錯誤或尾端的失敗旗標 (模擬 gas 用完)"""
+        eth = property(lambda self: self)
+
+        def call(self, tx, block_identifier="latest", state_override=None):
+            if lens_errors:
+                raise lens_errors.pop(0)
+            assert bytes(state_override[tx["to"]]["code"]) == LENS_RUNTIME_CODE
+            raw = bytearray(w3.eth.call({"to": lens, "data": tx["data"]}, block_identifier))
+            for i in range(len(raw) // 2 - flag_tail[0], len(raw) // 2):
+                raw[2 * i:2 * i + 2] = b"\xff\xff"
+            return bytes(raw)
+
+    multicall_calls = []
+
+    def make_fetcher(dm):
+        config.DEBT_MANAGER_ADDR = dm
+        fetcher = DataFetcher()
+
+        def direct_multicall(chunk, block_identifier, deadline_at):
+            multicall_calls.append(len(chunk))
+            values = []
+            for safe in chunk:
+                try:
+                    values.append(decode_user_state_ltv(call_debt_manager(w3, dm, safe, block_identifier)))
+                except Exception:  # revert (ContractLogicError) 或解碼失敗
+                    values.append(None)
+            return values, 0, None
+
+        fetcher._fetch_chunk_multicall = direct_multicall
+        return fetcher
+
+    node = OverrideNode()
+    fetcher_module.call_lens = lambda _w3, dm, safes, block="latest": call_lens(node, dm, safes, block)
+    safes = [make_safe(*case) for case in CASES[:5]] + [make_safe(20000 + i, 15000 + i) for i in range(20)]
+
+    # 1. 正確的 layout：試探通過，revert 的地址經 Multicall 重查後仍是 reverted
+    fetcher = make_fetcher(debt_manager)
+    batch = fetcher.fetch_ltv_batch(safes)
+    print(f"flat layout: lens={fetcher._lens_supported} {batch.counts()}")
+    assert fetcher._lens_supported is True
+    assert batch.status[safes[4]] == STATUS_REVERTED
+    assert batch.ltv[safes[0]] == 50.0 and batch.ltv[safes[1]] == 80.41
+    assert batch.counts()[STATUS_OK] == len(safes) - 1
+
+    # 2. 尾端被標記失敗 (eth_call 的 gas 用完)：改用 Multicall 重查，而不是當成 revert
+    flag_tail[0] = 5
+    multicall_calls.clear()
+    batch = fetcher.fetch_ltv_batch(safes)
+    print(f"flagged tail: {batch.counts()}, multicall re-queried {multicall_calls}")
+    assert multicall_calls == [6]  # 5 個尾端 + 原本就 revert 的那個
+    assert all(batch.status[s] == STATUS_OK for s in safes[-5:])
+    flag_tail[0] = 0
+
+    # 3. 重查也失敗時記為 failed，不是 reverted
+    fetcher._fetch_chunk_multicall = lambda chunk, block, deadline: (None, 0, RuntimeError("down"))
+    batch = fetcher.fetch_ltv_batch(safes)
+    assert batch.status[safes[4]] == STATUS_FAILED
+    fetcher = make_fetcher(debt_manager)
+
+    # 4. 暫時性 RPC 錯誤會重試，不會停用 lens
+    fetcher.retry_policy.base_delay = fetcher.retry_policy.max_delay = 0.01
+    fetcher._lens_supported = True
+    lens_errors.append(Web3RPCError("header not found", rpc_response={"error": {"code": -32000, "message": "header not found"}}))
+    batch = fetcher.fetch_ltv_batch(safes)
+    print(f"transient error: lens={fetcher._lens_supported} {batch.counts()}")
+    assert fetcher._lens_supported is True and batch.counts()[STATUS_RETRIED] == len(safes) - 1
+
+    # 5. 明確不支援 override 才停用
+    lens_errors.append(Web3RPCError("invalid params", rpc_response={"error": {"code": -32602, "message": "invalid params"}}))
+    batch = fetcher.fetch_ltv_batch(safes)
+    print(f"unsupported: lens={fetcher._lens_supported} {batch.counts()}")
+    assert fetcher._lens_supported is False and batch.counts()[STATUS_OK] == len(safes) - 1
+
+    # 6. layout 不一致 (tuple 包裝的回傳)：試探時與 Multicall 比對不符，lens 不會被啟用
+    try:
+        decode_user_state_ltv(call_debt_manager(w3, wrapped_debt_manager, safes[0]))
+        decoded = True
+    except Exception:
+        decoded = False
+    assert not decoded
+    fetcher = make_fetcher(wrapped_debt_manager)
+    fetcher.fetch_ltv_batch(safes)
+    print(f"wrapped layout: lens={fetcher._lens_supported}")
+    assert fetcher._lens_supported is False
+
+def main():
+    w3 = Web3(EthereumTesterProvider())
+    debt_manager = deploy(w3, MOCK_DEBT_MANAGER)
+    wrapped_debt_manager = deploy(w3, mock_debt_manager(wrapped=True))
+    lens = deploy(w3, LENS_RUNTIME_CODE)
+
+    check_lens(w3, debt_manager, lens)
+    check_fetcher(w3, debt_manager, wrapped_debt_manager, lens)
+
+if __name__ == "__main__":
+    main()
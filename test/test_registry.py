@@ -0,0 +1,92 @@
+import numpy as np
+
+import config
+from db import init_db, SessionLocal
+from db import crud
+from db.models import Monitor, MonitorChange
+from db.registry import MonitorRegistry
+
+def main():
+    print("Initializing Database...")
+    init_db()
+
+    db = SessionLocal()
+    registry = MonitorRegistry()
+
+    try:
+        tg_id = "123456"
+        addr_a = "0x7ca0b75e67e33c0014325b739a8d019c4fe445f0"
+        addr_b = "0x000000000000000000000000000000000000dead"
+
+        crud.add_monitor(db, tg_id, addr_a, "Main Vault")
+
+        # 1. 第一次 sync：整表載入
+        upserted, removed = registry.sync(db)
+        print(f"\nFull load: +{upserted} / -{removed}, seq={registry.synced_seq}")
+        base = len(registry)
+
+        # 2. 新增一筆：只拉差量
+        monitor_b, created = crud.add_monitor(db, tg_id, addr_b, "Dead Vault")
+        upserted, removed = registry.sync(db)
+        print(f"Delta after add: +{upserted} / -{removed}, seq={registry.synced_seq}")
+        assert len(registry) == base + (1 if created else 0)
+
+        row = registry.row_of(monitor_b.id)
+        assert bytes(registry.addresses[row]).hex() == addr_b[2:]
+        assert registry.chat_ids[row] == int(tg_id)
+
+        # 3. 向量比較閾值 (-1.0 代表查詢失敗，不應觸發)
+        ltv = np.full(len(registry), -1.0, dtype=np.float32)
+        ltv[row] = 95.0
+        breaching = np.flatnonzero(registry.breaching(ltv))
+        print(f"Breaching rows: {breaching}")
+        assert list(breaching) == [row]
+
+        # 4. 刪除：tombstone 讓 registry 移除該 row
+        crud.delete_monitor(db, tg_id, addr_b)
+        upserted, removed = registry.sync(db)
+        print(f"Delta after delete: +{upserted} / -{removed}, seq={registry.synced_seq}")
+        assert registry.row_of(monitor_b.id) is None
+        assert len(registry) == base
+
+        # 5. 沒有新變更時 sync 不做事
+        assert registry.sync(db) == (0, 0)
+
+        # 6. 較小的 seq 較晚 commit (Postgres 並行交易)：lookback 視窗會補上
+        user = crud.get_user_by_tg_id(db, tg_id)
+        late_seq = registry.synced_seq + 1
+        db.add(MonitorChange(id=late_seq + 1, monitor_id=registry.monitor_ids[0].item(), op="upsert"))
+        db.commit()
+        registry.sync(db)
+        assert registry.synced_seq == late_seq + 1
+
+        monitor_c = Monitor(user_id=user.id, safe_address="0x" + "c" * 40, name="Late Vault", alert_threshold=75.0)
+        db.add(monitor_c)
+        db.flush()
+        db.add(MonitorChange(id=late_seq, monitor_id=monitor_c.id, op="upsert"))
+        db.commit()
+        upserted, removed = registry.sync(db)
+        print(f"Delta after late commit: +{upserted} / -{removed}, seq={registry.synced_seq}")
+        assert registry.row_of(monitor_c.id) is not None
+        assert registry.sync(db) == (0, 0)  # 已套用過的不會重複套用
+
+        # 7. 整表載入後修剪視窗以下的 change log
+        lookback = config.REGISTRY_SYNC_LOOKBACK
+        config.REGISTRY_SYNC_LOOKBACK = 1
+        try:
+            registry.sync(db, full=True)
+        finally:
+            config.REGISTRY_SYNC_LOOKBACK = lookback
+        remaining = [change[0] for change in crud.get_monitor_changes(db, 0)]
+        print(f"Change log after prune: {remaining}")
+        assert remaining == [registry.synced_seq]
+
+        crud.delete_monitor(db, tg_id, monitor_c.safe_address)
+        registry.sync(db)
+        assert registry.row_of(monitor_c.id) is None
+
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+RPC 韌性測試：重試 / 退避、deadline、circuit breaker 狀態轉移，
+以及 fetch_ltv_batch 在不穩定節點下的部分結果與 stale 沿用。
+
+需要：pip install "eth-tester[py-evm]"
+Fetcher 的 w3 換成本地 EVM (不連外部 RPC)，Multicall 換成依機率失敗的假呼叫。
+"""
+import random
+import threading
+import time
+
+from web3 import Web3
+
+import config
+from local_chain import use_local_chain
+
+# 在 import fetcher 之前換掉 RPC 連線與合約地址
+use_local_chain()
+config.LTV_LENS_ENABLED = False
+
+from blockchain.fetcher import DataFetcher
+from blockchain.ltv import STATUS_OK, STATUS_RETRIED, STATUS_STALE, STATUS_FAILED, STATUS_REVERTED
+from blockchain.resilience import (
+    CircuitBreaker, RetryPolicy, RPCError, CircuitOpenError, DeadlineExceeded, call_with_retry,
+)
+
+RESET = 0.2
+
+class FlakyNode:
+    """依 failure_rate 隨機失敗的假 RPC；fail_addrs 中的地址所在的批次永遠失敗"""
+
+    def __init__(self, failure_rate: float, seed: int = 0):
+        self.failure_rate = failure_rate
+        self.fail_addrs = set()
+        self.revert_addrs = set()
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, chunk):
+        with self._lock:
+            self.calls += 1
+            fail = self._rng.random() < self.failure_rate
+        if fail or self.fail_addrs.intersection(chunk):
+            raise ConnectionError("upstream timeout")
+        return [None if addr in self.revert_addrs else 50.0 for addr in chunk]
+
+def make_fetcher(node: FlakyNode, attempts: int = 4) -> DataFetcher:
+    fetcher = DataFetcher()
+    fetcher.retry_policy = RetryPolicy(attempts, base_delay=0.01, max_delay=0.05)
+    fetcher.breaker = CircuitBreaker(failure_threshold=5, reset_timeout=RESET)
+
+    def fetch_chunk_multicall(chunk, block_identifier, deadline_at):
+        # 與 _fetch_chunk_multicall 相同的回傳格式
+        try:
+            values, retries = call_with_retry(
+                lambda: node(chunk), fetcher.retry_policy, fetcher.breaker, deadline_at
+            )
+        except RPCError as e:
+            return None, 0, e
+        return values, retries, None
+
+    fetcher._fetch_chunk_multicall = fetch_chunk_multicall
+    return fetcher
+
+def check_breaker():
+    print("--- Circuit breaker ---")
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=RESET)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+    assert 0 < breaker.retry_after() <= RESET
+
+    time.sleep(RESET)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() and not breaker.allow()  # half-open 只放行一個試探
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN  # 試探失敗 -> 再次開啟
+
+    time.sleep(RESET)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.retry_after() == 0
+    print("closed -> open -> half_open -> open -> half_open -> closed")
+
+def check_retry():
+    print("\n--- Retry / deadline ---")
+    policy = RetryPolicy(attempts=4, base_delay=0.01, max_delay=0.05)
+    assert all(0 <= policy.backoff(n) <= 0.05 for n in range(10))
+
+    # 前兩次失敗、第三次成功
+    outcomes = iter([ConnectionError("a"), ConnectionError("b"), "ok"])
+    def flaky():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=RESET)
+    assert call_with_retry(flaky, policy, breaker) == ("ok", 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # fatal 例外直接往上拋，不重試、不計入 breaker
+    calls = []
+    def reverts():
+        calls.append(1)
+        raise ValueError("execution reverted")
+    try:
+        call_with_retry(reverts, policy, breaker, fatal=(ValueError,))
+        raise AssertionError("expected ValueError")
+    except ValueError:
+        pass
+    assert len(calls) == 1 and breaker.state == CircuitBreaker.CLOSED
+
+    # 重試次數用完
+    def down():
+        raise ConnectionError("down")
+    try:
+        call_with_retry(down, RetryPolicy(3, 0.0, 0.0), CircuitBreaker(10, RESET))
+        raise AssertionError("expected RPCError")
+    except RPCError as e:
+        assert not isinstance(e, (CircuitOpenError, DeadlineExceeded))
+
+    # 退避會超過 deadline 時提早放棄
+    start = time.monotonic()
+    try:
+        call_with_retry(down, RetryPolicy(10, 1.0, 1.0), CircuitBreaker(10, RESET), deadline=start + 0.05)
+        raise AssertionError("expected DeadlineExceeded")
+    except DeadlineExceeded:
+        pass
+    assert time.monotonic() - start < 0.5
+    print("retry, fatal passthrough, exhaustion and deadline OK")
+
+def check_open_breaker_waits():
+    print("\n--- Open breaker within deadline ---")
+    policy = RetryPolicy(attempts=2, base_delay=0.01, max_delay=0.01)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=RESET)
+    breaker.record_failure()
+
+    # 沒有 deadline：立即失敗 (例如 /add 的單次查詢)
+    try:
+        call_with_retry(lambda: "ok", policy, breaker)
+        raise AssertionError("expected CircuitOpenError")
+    except CircuitOpenError:
+        pass
+
+    # deadline 比 reset_timeout 短：等不到 half-open
+    try:
+        call_with_retry(lambda: "ok", policy, breaker, deadline=time.monotonic() + RESET / 4)
+        raise AssertionError("expected CircuitOpenError")
+    except CircuitOpenError:
+        pass
+
+    # deadline 足夠：等到 half-open 後試探成功，不消耗重試次數
+    start = time.monotonic()
+    assert call_with_retry(lambda: "ok", policy, breaker, deadline=start + 5) == ("ok", 0)
+    waited = time.monotonic() - start
+    print(f"Waited {waited:.2f}s for half-open")
+    assert waited < 5 and breaker.state == CircuitBreaker.CLOSED
+
+def check_fetch_batch():
+    chunk_size, config.MULTICALL_CHUNK_SIZE = config.MULTICALL_CHUNK_SIZE, 10
+    try:
+        addresses = [Web3.to_checksum_address(f"0x{i + 1:040x}") for i in range(200)]
+
+        print("\n--- Flaky provider (30% of calls fail) ---")
+        node = FlakyNode(0.3)
+        fetcher = make_fetcher(node)
+        start = time.monotonic()
+        batch = fetcher.fetch_ltv_batch(addresses, deadline=10)
+        counts = batch.counts()
+        print(f"{counts} in {time.monotonic() - start:.2f}s, {node.calls} calls, breaker {fetcher.breaker.state}")
+        assert counts.get(STATUS_OK, 0) + counts.get(STATUS_RETRIED, 0) == len(addresses)
+        assert counts.get(STATUS_RETRIED, 0) > 0
+        assert batch.block_number is not None and not batch.rpc_failed
+
+        # 不重試時同樣的節點會掉一大截
+        baseline = make_fetcher(FlakyNode(0.3), attempts=1).fetch_ltv_batch(addresses, deadline=10).counts()
+        print(f"Without retries: {baseline}")
+        assert baseline.get(STATUS_OK, 0) < counts.get(STATUS_OK, 0) + counts.get(STATUS_RETRIED, 0)
+
+        print("\n--- Partial results ---")
+        node.failure_rate = 0.0
+        node.fail_addrs = {addresses[0]}  # 第一批永遠失敗
+        node.revert_addrs = {addresses[15]}
+        fetcher.breaker = CircuitBreaker(failure_threshold=50, reset_timeout=RESET)
+        batch = fetcher.fetch_ltv_batch(addresses, deadline=2)
+        print(batch.counts())
+        assert [batch.status[a] for a in addresses[:10]] == [STATUS_STALE] * 10  # 沿用上一輪的值
+        assert batch.ltv[addresses[0]] == 50.0
+        assert batch.status[addresses[15]] == STATUS_REVERTED and batch.ltv[addresses[15]] == -1.0
+        assert batch.counts()[STATUS_OK] == len(addresses) - 11
+        assert addresses[15] in batch.as_ltv_map()
+
+        print("\n--- Full outage ---")
+        node.failure_rate = 1.0
+        fetcher.breaker = CircuitBreaker(failure_threshold=5, reset_timeout=RESET)
+        stale_age, config.STALE_MAX_AGE_SECONDS = config.STALE_MAX_AGE_SECONDS, 0
+        try:
+            start = time.monotonic()
+            batch = fetcher.fetch_ltv_batch(addresses, deadline=1)
+            elapsed = time.monotonic() - start
+        finally:
+            config.STALE_MAX_AGE_SECONDS = stale_age
+        print(f"{batch.counts()} in {elapsed:.2f}s, breaker {fetcher.breaker.state}")
+        assert batch.counts() == {STATUS_FAILED: len(addresses)} and batch.rpc_failed
+        assert batch.as_ltv_map() == {}
+        assert fetcher.breaker.state in (CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)
+        assert elapsed < 3  # 受 deadline 限制
+
+        # 節點恢復：half-open 試探成功後整輪正常
+        node.failure_rate = 0.0
+        node.fail_addrs = set()
+        batch = fetcher.fetch_ltv_batch(addresses, deadline=5)
+        print(f"Recovered: {batch.counts()}, breaker {fetcher.breaker.state}")
+        assert batch.counts().get(STATUS_FAILED, 0) == 0 and fetcher.breaker.state == CircuitBreaker.CLOSED
+    finally:
+        config.MULTICALL_CHUNK_SIZE = chunk_size
+
+def main():
+    check_breaker()
+    check_retry()
+    check_open_breaker_waits()
+    check_fetch_batch()
+
+if __name__ == "__main__":
+    main()
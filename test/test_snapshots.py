@@ -0,0 +1,168 @@
+"""
+LTV 快照表測試 (建議用 SQLite：DATABASE_URL=sqlite:///./test.db)：
+條件式 upsert (舊區塊不覆蓋新區塊)、重啟時的 warm-up，以及 /list refresh 只刷新過舊的地址。
+
+需要：pip install "eth-tester[py-evm]" (Fetcher 的 w3 換成本地 EVM，不連外部 RPC)
+"""
+import asyncio
+import types
+from datetime import datetime, timedelta
+
+from web3 import Web3
+
+import config
+from local_chain import use_local_chain
+
+use_local_chain()
+
+from blockchain.ltv import BatchResult, STATUS_OK
+from bot.alerts import STATE_OK, STATE_COOLDOWN
+from db import init_db, SessionLocal, crud
+from db.models import LtvSnapshot
+from db.registry import to_epoch
+import bot.handlers as handlers
+import bot.monitor_loop as monitor_loop
+
+TG_ID = "777000"
+SAFE_A = Web3.to_checksum_address("0x7ca0b75e67e33c0014325b739a8d019c4fe445f0")
+SAFE_B = Web3.to_checksum_address("0x000000000000000000000000000000000000dead")
+
+def snapshot(addr, ltv, block, updated_at):
+    return {"safe_address": addr, "ltv": ltv, "status": STATUS_OK, "block_number": block, "updated_at": updated_at}
+
+def check_upsert(db):
+    print("--- Conditional upsert ---")
+    now = datetime.utcnow()
+    crud.upsert_ltv_snapshots(db, [snapshot(SAFE_A, 50.0, 100, now)])
+
+    # 較舊的區塊 (例如較慢的 /list refresh 晚寫入) 不會覆蓋
+    crud.upsert_ltv_snapshots(db, [snapshot(SAFE_A, 99.0, 90, now + timedelta(seconds=5))])
+    saved = crud.get_ltv_snapshots(db, [SAFE_A])[SAFE_A]
+    print(f"After older block: {saved.ltv}% @ {saved.block_number}")
+    assert (saved.ltv, saved.block_number) == (50.0, 100)
+
+    # 相同或較新的區塊會覆蓋
+    crud.upsert_ltv_snapshots(db, [snapshot(SAFE_A, 61.5, 110, now)])
+    saved = crud.get_ltv_snapshots(db, [SAFE_A])[SAFE_A]
+    print(f"After newer block: {saved.ltv}% @ {saved.block_number}")
+    assert (saved.ltv, saved.block_number) == (61.5, 110)
+
+def check_warm(db):
+    print("\n--- Warm-up from snapshots ---")
+    monitor_a, _ = crud.add_monitor(db, TG_ID, SAFE_A, "Snapshot Vault")
+    monitor_b, _ = crud.add_monitor(db, TG_ID, SAFE_B, "Fresh Vault")
+    registry = monitor_loop.registry
+    registry.sync(db, full=True)
+    monitor_loop._warm_from_snapshots(db)
+
+    saved = crud.get_ltv_snapshots(db, [SAFE_A])[SAFE_A]
+    row_a = registry.row_of(monitor_a.id)
+    row_b = registry.row_of(monitor_b.id)
+    print(f"A: ltv={registry.column('last_ltv')[row_a]} next={registry.column('next_check_at')[row_a]}")
+    assert abs(registry.column("last_ltv")[row_a] - saved.ltv) < 1e-4
+    assert registry.column("last_checked_at")[row_a] == to_epoch(saved.updated_at)
+    assert registry.column("next_check_at")[row_a] == to_epoch(saved.updated_at) + config.MONITOR_INTERVAL_SECONDS
+
+    # 沒有快照的 monitor 第一輪就要檢查
+    assert registry.column("last_ltv")[row_b] == -1.0 and registry.column("next_check_at")[row_b] == 0
+
+    # 接近閾值或尚未恢復 OK 的 monitor 重啟後沒有趨勢可用，第一輪就檢查
+    threshold = registry.thresholds[row_a]
+    registry.thresholds[row_a] = saved.ltv + config.NEAR_THRESHOLD_MARGIN / 2
+    monitor_loop._warm_from_snapshots(db)
+    assert registry.column("next_check_at")[row_a] == 0
+    registry.thresholds[row_a] = threshold
+
+    registry.column("alert_state")[row_a] = STATE_COOLDOWN
+    monitor_loop._warm_from_snapshots(db)
+    assert registry.column("next_check_at")[row_a] == 0
+    registry.column("alert_state")[row_a] = STATE_OK
+
+def check_list_refresh():
+    print("\n--- /list refresh ---")
+    fetched = []
+
+    class FakeFetcher:
+        def fetch_ltv_batch(self, addresses, block_identifier="latest", deadline=None):
+            fetched.extend(addresses)
+            result = BatchResult(block_identifier)
+            result.block_number = 120
+            for addr in addresses:
+                result.set(addr, 42.0, STATUS_OK, datetime.utcnow().timestamp())
+            return result
+
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=int(TG_ID)),
+        message=types.SimpleNamespace(reply_text=reply_text),
+    )
+    fetcher, handlers.Fetcher = handlers.Fetcher, FakeFetcher()
+    try:
+        asyncio.run(handlers.list_monitors_handler(update, types.SimpleNamespace(args=["refresh"])))
+    finally:
+        handlers.Fetcher = fetcher
+
+    print(replies[-1])
+    # SAFE_A 的快照剛寫入，不需要重查；SAFE_B 沒有快照
+    assert fetched == [SAFE_B]
+    assert "42.00% LTV" in replies[-1] and "block 120" in replies[-1]
+    assert "61.50% LTV" in replies[-1] and "block 110" in replies[-1]
+
+def check_snapshot_write_failure():
+    print("\n--- Snapshot write failure ---")
+
+    class BreachingFetcher:
+        def fetch_ltv_batch(self, addresses, block_identifier="latest", deadline=None):
+            result = BatchResult(block_identifier)
+            result.block_number = 130
+            for addr in addresses:
+                result.set(addr, 95.0, STATUS_OK, datetime.utcnow().timestamp())
+            return result
+
+    sent = []
+
+    async def send_message(chat_id, text):
+        sent.append(text)
+
+    def broken_upsert(db, rows):
+        raise RuntimeError("database is locked")
+
+    registry = monitor_loop.registry
+    registry.column("next_check_at")[:] = 0
+    saved = (monitor_loop.Fetcher, monitor_loop.upsert_ltv_snapshots, monitor_loop.app_instance)
+    monitor_loop.Fetcher = BreachingFetcher()
+    monitor_loop.upsert_ltv_snapshots = broken_upsert
+    monitor_loop.app_instance = types.SimpleNamespace(bot=types.SimpleNamespace(send_message=send_message))
+    try:
+        asyncio.run(monitor_loop.monitor_ltv_check())
+    finally:
+        monitor_loop.Fetcher, monitor_loop.upsert_ltv_snapshots, monitor_loop.app_instance = saved
+
+    # 快照寫入失敗不影響本輪警報
+    print(sent[-1] if sent else "(nothing sent)")
+    assert len(sent) == 1 and "95.00% LTV" in sent[0]
+    assert (registry.last_alert_at > 0).sum() == 2
+
+def main():
+    init_db()
+    db = SessionLocal()
+    try:
+        # 清掉上次執行留下的資料
+        db.query(LtvSnapshot).filter(LtvSnapshot.safe_address.in_([SAFE_A, SAFE_B])).delete(synchronize_session=False)
+        db.commit()
+        for addr in (SAFE_A, SAFE_B):
+            crud.delete_monitor(db, TG_ID, addr)
+
+        check_upsert(db)
+        check_warm(db)
+        check_list_refresh()
+        check_snapshot_write_failure()
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()